@@ -0,0 +1,183 @@
+import os
+import json
+import math
+import time
+import uuid
+import fcntl
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import pid_alive
+
+
+class Overloaded(Exception):
+    """Рендер не помещается в бюджет; retry_after — через сколько секунд повторить"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """Бюджет на одновременные рендеры: память (МБ) и CPU-секунды.
+
+    Рендер, который не помещается, ждёт в очереди (FIFO, не дольше timeout
+    и не больше max_waiting ожидающих), иначе — Overloaded со сроком, когда
+    по оценке освободится место. Если рендеров нет, пропускается любой, даже
+    больше бюджета: иначе он не выполнился бы никогда.
+
+    С directory бюджет общий для всех процессов (воркеры gunicorn обслуживают
+    по одному запросу): каждый рендер — файл <pid>-<ключ>.json, проверка и
+    запись идут под flock, файлы умерших процессов удаляются. Освобождение в
+    другом процессе не будит ожидающих, поэтому они перепроверяют раз в poll
+    секунд; порядок FIFO — только внутри процесса.
+    """
+
+    def __init__(self, memory_mb=1024, cpu_seconds=120, timeout=10, max_waiting=8, directory=None, poll=0.25):
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self.directory = directory
+        self.poll = poll
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.condition = threading.Condition()
+        self.active = {}
+        self.waiting = deque()
+        self.admitted = 0
+        self.rejected = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{os.getpid()}-{key}.json')
+
+    @contextmanager
+    def locked(self):
+        """Блокировка каталога между процессами на время проверки и записи"""
+        if not self.directory:
+            yield
+            return
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def renders(self):
+        """Рендеры в работе во всех процессах: [(оценка, время начала)]"""
+        if not self.directory:
+            return list(self.active.values())
+        renders = []
+        for name in os.listdir(self.directory):
+            pid = name.split('-', 1)[0]
+            if not name.endswith('.json') or not pid.isdigit():
+                continue
+            path = os.path.join(self.directory, name)
+            if not pid_alive(int(pid)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            renders.append((data['cost'], data['started']))
+        return renders
+
+    def in_use(self, renders=None):
+        renders = self.renders() if renders is None else renders
+        return (sum(cost['memory_mb'] for cost, _ in renders),
+                sum(cost['cpu_seconds'] for cost, _ in renders))
+
+    def fits(self, cost):
+        renders = self.renders()
+        if not renders:
+            return True
+        memory, cpu = self.in_use(renders)
+        return memory + cost['memory_mb'] <= self.memory_mb and cpu + cost['cpu_seconds'] <= self.cpu_seconds
+
+    def retry_after(self, cost):
+        """Оценка: рендеры заканчиваются за свои CPU-секунды, ждём, пока освободится достаточно"""
+        now = time.time()
+        renders = self.renders()
+        memory, cpu = self.in_use(renders)
+        finish = now
+        for cost_done, started in sorted(renders, key=lambda item: item[1] + item[0]['cpu_seconds']):
+            memory -= cost_done['memory_mb']
+            cpu -= cost_done['cpu_seconds']
+            finish = started + cost_done['cpu_seconds']
+            if memory + cost['memory_mb'] <= self.memory_mb and cpu + cost['cpu_seconds'] <= self.cpu_seconds:
+                break
+        # Рендер больше бюджета пройдёт, когда закончатся все
+        return max(1, math.ceil(finish - now))
+
+    def occupy(self, cost):
+        """Занять бюджет без проверки (например, задачи, принятые до перезапуска); возвращает ключ"""
+        key = uuid.uuid4().hex
+        started = time.time()
+        if self.directory:
+            tmp_path = f'{self.path(key)}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'cost': cost, 'started': started}, f)
+            os.replace(tmp_path, self.path(key))
+        self.active[key] = (cost, started)
+        return key
+
+    def admit(self, cost, timeout=None):
+        """Занять бюджет; возвращает ключ для release. timeout=0 — без ожидания"""
+        timeout = self.timeout if timeout is None else timeout
+        ticket = object()
+        with self.condition:
+            if len(self.waiting) >= self.max_waiting and not self.fits(cost):
+                self.rejected += 1
+                raise Overloaded('Сервер перегружен, попробуйте позже', self.retry_after(cost))
+            self.waiting.append(ticket)
+            deadline = time.monotonic() + timeout
+            try:
+                while True:
+                    if self.waiting[0] is ticket:
+                        with self.locked():
+                            if self.fits(cost):
+                                key = self.occupy(cost)
+                                break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise Overloaded('Сервер перегружен, попробуйте позже', self.retry_after(cost))
+                    self.condition.wait(min(remaining, self.poll) if self.directory else remaining)
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+            self.admitted += 1
+        return key
+
+    def release(self, key):
+        with self.condition:
+            self.active.pop(key, None)
+            if self.directory:
+                try:
+                    os.remove(self.path(key))
+                except FileNotFoundError:
+                    pass
+            self.condition.notify_all()
+
+    def stats(self):
+        """Занятость бюджета по всем процессам; waiting, admitted и rejected — этого процесса"""
+        with self.condition:
+            renders = self.renders()
+            memory, cpu = self.in_use(renders)
+            return {
+                'active': len(renders),
+                'waiting': len(self.waiting),
+                'memory_mb': round(memory, 1),
+                'cpu_seconds': round(cpu, 2),
+                'memory_budget_mb': self.memory_mb,
+                'cpu_budget_seconds': self.cpu_seconds,
+                'admitted': self.admitted,
+                'rejected': self.rejected
+            }
@@ -1,14 +1,24 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory, redirect
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, redirect, stream_with_context
 from flask_cors import CORS
 import os
+import re
 import json
+import atexit
 from datetime import datetime
-from music_generator import ProMusicGenerator as SimpleMusicGenerator
+from urllib.parse import quote
+from music_generator import (ProMusicGenerator as SimpleMusicGenerator, RenderCache, StageTimer, stage, AUDIO_FORMATS,
+                             CHANNEL_LAYOUTS, SAMPLE_RATES, DRAFT_SAMPLE_RATE, LOUDNESS_RANGE,
+                             PREVIEW_SAMPLE_RATE, PREVIEW_SECONDS)
+from render_jobs import JobStore, JobManager
+from request_log import RequestLog, server_timing
+from metrics import Metrics
+from admission import AdmissionControl, Overloaded
 import uuid
 import time
+import secrets
 
 app = Flask(__name__, static_folder='static', static_url_path='')
-CORS(app)
+CORS(app, expose_headers=['X-Filename', 'X-Download-URL', 'X-Seed', 'X-MIDI-URL', 'Server-Timing'])
 
 generator = SimpleMusicGenerator()
 os.makedirs('generated', exist_ok=True)
@@ -17,6 +27,30 @@ os.makedirs('generated', exist_ok=True)
 UPLOAD_FOLDER = 'static/files'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Потоковый рендер держит память постоянной, но длину всё равно ограничиваем
+MAX_LENGTH_MIN = 60
+# Темп задаёт длину сегмента (память) и число нот (CPU)
+MIN_TEMPO, MAX_TEMPO = 40, 240
+
+# Готовые треки адресуются хешем (параметры, сид, версия движка)
+render_cache = RenderCache(UPLOAD_FOLDER)
+
+# Журнал запросов: JSON-строка со временем стадий на каждый рендер
+request_log = RequestLog()
+
+# Метрики Prometheus: файл на процесс, сумма по всем процессам при опросе /metrics
+metrics = Metrics()
+
+# Бюджет рендеров сервера (общий для воркеров gunicorn и фоновых задач):
+# лишние ждут в очереди или получают 429 с Retry-After
+admission = AdmissionControl(
+    memory_mb=float(os.environ.get('RENDER_MEMORY_BUDGET_MB', 1024)),
+    cpu_seconds=float(os.environ.get('RENDER_CPU_BUDGET_SECONDS', 120)),
+    timeout=float(os.environ.get('ADMISSION_TIMEOUT', 10)),
+    max_waiting=int(os.environ.get('ADMISSION_MAX_WAITING', 8)),
+    directory=os.environ.get('ADMISSION_DIR', 'admission')
+)
+
 # 🔐 SSO ФУНКЦИИ
 def load_users():
     if os.path.exists('users.json'):
@@ -28,6 +62,26 @@ def save_users(data):
     with open('users.json', 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
+def remove_track(filename):
+    """Удаление трека; общий MIDI удаляется вместе с последним аудиофайлом"""
+    stem = os.path.splitext(filename)[0]
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    midi_path = os.path.join(UPLOAD_FOLDER, stem + '.mid')
+    if os.path.exists(midi_path) and not any(
+        os.path.exists(os.path.join(UPLOAD_FOLDER, stem + '.' + ext)) for ext in AUDIO_FORMATS
+    ):
+        os.remove(midi_path)
+
+def file_in_use(users, filename, except_session=None):
+    """Файл из кэша может принадлежать нескольким сессиям"""
+    return any(
+        f['filename'] == filename
+        for sid, session in users['sessions'].items() if sid != except_session
+        for f in session.get('files', [])
+    )
+
 # 🔐 API РЕГИСТРАЦИЯ
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -126,8 +180,81 @@ def catch_all(path):
         return send_from_directory('static', 'index.html')
 
 # 🎵 МУЗЫКА (ИСПРАВЛЕНО)
+def render_params(data):
+    """Параметры рендера из запроса, с ограничением длины; без сида выбирается случайный"""
+    seed = data.get('seed')
+    audio_format = str(data.get('format', 'wav')).lower()
+    # Раскладка: 'mono'/'stereo' или число каналов; моно — вдвое меньше байт
+    layout = str(data.get('channels', 'stereo')).lower()
+    channels = CHANNEL_LAYOUTS.get(layout) or (int(layout) if layout in ('1', '2') else 2)
+    # Черновик рендерится на половинной частоте; частота файла — по запросу (22050/44100/48000)
+    draft = str(data.get('draft', '')).lower() in ('1', 'true', 'yes')
+    render_rate = DRAFT_SAMPLE_RATE if draft else generator.sample_rate
+    sample_rate = int(data.get('sample_rate') or render_rate)
+    # Целевая громкость мастера в дБ FS; без неё — фиксированное усиление
+    loudness = data.get('loudness')
+    if loudness not in (None, ''):
+        loudness = min(max(float(loudness), LOUDNESS_RANGE[0]), LOUDNESS_RANGE[1])
+    else:
+        loudness = None
+    return {
+        'genre': data.get('genre', 'Поп'),
+        'mood': data.get('mood', 'Радость'),
+        'instrument': data.get('instrument', 'Электронные'),
+        'length_min': min(max(int(data.get('length', 2)), 1), MAX_LENGTH_MIN),
+        'tempo_bpm': min(max(int(data.get('tempo', 120)), MIN_TEMPO), MAX_TEMPO),
+        'seed': int(seed) if seed not in (None, '') else secrets.randbelow(2 ** 31),
+        'audio_format': audio_format if audio_format in AUDIO_FORMATS else 'wav',
+        'loudness': loudness,
+        'channels': channels,
+        'sample_rate': sample_rate if sample_rate in SAMPLE_RATES else render_rate,
+        'render_rate': render_rate
+    }
+
+def timed_response(response, timer, started, **record):
+    """Server-Timing в ответ и запись в журнал запросов"""
+    total = time.perf_counter() - started
+    stages = timer.snapshot()
+    response.headers['Server-Timing'] = server_timing(stages, total)
+    request_log.append(route=request.path, method=request.method, status=response.status_code,
+                       total=round(total, 4), stages=stages, **record)
+    return response
+
+def render_cost(params, seconds=None):
+    """Оценка рендера по модели генератора; у превью — только его отрывок"""
+    length_min = seconds / 60 if seconds else params['length_min']
+    return generator.render_cost(length_min, params['tempo_bpm'], params['instrument'],
+                                 params.get('audio_format', 'wav'), params.get('channels', 2),
+                                 params.get('sample_rate'), params.get('render_rate'))
+
+def overloaded_response(error):
+    response = jsonify({'success': False, 'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def register_file(session_id, description, filename):
+    """Запись готового файла в список файлов сессии"""
+    if not session_id:
+        return
+    users = load_users()
+    if session_id in users['sessions']:
+        if 'files' not in users['sessions'][session_id]:
+            users['sessions'][session_id]['files'] = []
+        
+        file_info = {
+            'name': description[:50],
+            'filename': filename,
+            'size': os.path.getsize(os.path.join(UPLOAD_FOLDER, filename)),
+            'created': time.time()
+        }
+        users['sessions'][session_id]['files'].append(file_info)
+        save_users(users)
+
 @app.route('/generate_music', methods=['POST'])
 def generate_music():
+    started = time.perf_counter()
+    timer = StageTimer()
     try:
         data = request.json
         print(f"Получены параметры: {data}")
@@ -135,46 +262,172 @@ def generate_music():
         # Получаем session_id
         session_id = request.headers.get('X-Session-ID') or data.get('session_id')
         
-        filename = generator.generate_music(
-            data.get('genre', 'Поп'),
-            data.get('mood', 'Радость'),
-            data.get('instrument', 'Электронные'),
-            int(data.get('length', 2)),
-            int(data.get('tempo', 120)),
-            data.get('description', 'Новый трек')
-        )
-        
-        # ✅ ПЕРЕМЕСТИТЬ ФАЙЛ
-        old_path = os.path.join('generated', filename)
-        new_path = os.path.join(UPLOAD_FOLDER, filename)
-        
-        if os.path.exists(old_path):
-            os.rename(old_path, new_path)
-        
-        # ✅ СОХРАНИТЬ В users.json
-        if session_id:
-            users = load_users()
-            if session_id in users['sessions']:
-                if 'files' not in users['sessions'][session_id]:
-                    users['sessions'][session_id]['files'] = []
-                
-                file_info = {
-                    'name': data.get('description', 'Новый трек')[:50],
-                    'filename': filename,
-                    'size': os.path.getsize(new_path),
-                    'created': time.time()
-                }
-                users['sessions'][session_id]['files'].append(file_info)
-                save_users(users)
+        params = render_params(data)
         
-        return jsonify({
+        # 👂 ПРЕВЬЮ: короткий моно-отрывок сразу в ответе, без файла и сессии
+        if data.get('preview'):
+            # Превью всегда моно WAV
+            for key in ('audio_format', 'channels', 'sample_rate', 'render_rate'):
+                params.pop(key)
+            # Оценка по тому, что реально рендерится: обрезанный отрывок, моно, частота превью
+            seconds = min(max(float(data.get('preview_seconds', 15)), PREVIEW_SECONDS[0]), PREVIEW_SECONDS[1])
+            cost = render_cost({**params, 'channels': 1, 'sample_rate': PREVIEW_SAMPLE_RATE,
+                                'render_rate': PREVIEW_SAMPLE_RATE}, seconds)
+            with timer.activate():
+                with stage('admission'):
+                    ticket = admission.admit(cost)
+                try:
+                    with metrics.in_flight('preview'), stage('preview'):
+                        wav = generator.preview_wav(**params, seconds=seconds)
+                finally:
+                    admission.release(ticket)
+            metrics.observe_render('preview', params, time.perf_counter() - started)
+            response = Response(wav, mimetype='audio/wav', headers={'X-Seed': str(params['seed'])})
+            return timed_response(response, timer, started, params=params, preview=True)
+        
+        filename = generator.track_filename(**params)
+        
+        with timer.activate():
+            # ✅ ПОВТОРНЫЙ ЗАПРОС — ОТДАЁМ С ДИСКА БЕЗ РЕНДЕРА
+            with stage('cache'):
+                cached = render_cache.lookup(filename)
+            stats = {}
+            if not cached:
+                # ✅ РЕНДЕР СРАЗУ В UPLOAD_FOLDER: под временным именем, готовый файл появляется атомарно
+                new_path = os.path.join(UPLOAD_FOLDER, filename)
+                part_path = f'{new_path}.{uuid.uuid4().hex}.part'
+                with stage('admission'):
+                    ticket = admission.admit(render_cost(params))
+                render_started = time.perf_counter()
+                try:
+                    with metrics.in_flight('generate'):
+                        stats = generator.render_file(part_path, **params)
+                    with stage('rename'):
+                        os.replace(part_path, new_path)
+                except Exception:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    raise
+                finally:
+                    admission.release(ticket)
+                metrics.observe_render('generate', params, time.perf_counter() - render_started, stats['bytes'])
+            with stage('midi'):
+                generator.write_midi(UPLOAD_FOLDER, params)
+            
+            # ✅ СОХРАНИТЬ В users.json
+            with stage('users'):
+                register_file(session_id, data.get('description', 'Новый трек'), filename)
+        
+        response = jsonify({
             'success': True, 
             'filename': filename,
-            'download_url': f'/files/{filename}'
+            'download_url': f'/files/{filename}',
+            'midi_url': f'/midi/{filename}',
+            'seed': params['seed'],
+            'format': params['audio_format'],
+            'channels': params['channels'],
+            'sample_rate': params['sample_rate'],
+            'cached': cached,
+            **stats
         })
+        return timed_response(response, timer, started, params=params, filename=filename, cached=cached)
+    except Overloaded as e:
+        return timed_response(overloaded_response(e), timer, started, error=str(e))
     except Exception as e:
         print(f"Ошибка генерации: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+        response = jsonify({'success': False, 'error': str(e)})
+        response.status_code = 500
+        return timed_response(response, timer, started, error=str(e))
+
+# 🎧 ПОТОКОВАЯ ГЕНЕРАЦИЯ: WAV/FLAC отдаётся по мере рендера
+@app.route('/generate_music/stream', methods=['GET', 'POST'])
+def generate_music_stream():
+    started = time.perf_counter()
+    timer = StageTimer()
+    try:
+        data = request.get_json(silent=True) or request.args.to_dict()
+        session_id = request.headers.get('X-Session-ID') or data.get('session_id')
+        description = data.get('description', 'Новый трек')
+        params = render_params(data)
+        
+        filename = generator.track_filename(**params)
+        headers = {
+            'X-Filename': quote(filename),
+            'X-Download-URL': quote(f'/files/{filename}'),
+            'X-MIDI-URL': quote(f'/midi/{filename}'),
+            'X-Seed': str(params['seed'])
+        }
+        mimetype = AUDIO_FORMATS[params['audio_format']]
+        with timer.activate():
+            with stage('cache'):
+                cached = render_cache.lookup(filename)
+            if cached:
+                with stage('midi'):
+                    generator.write_midi(UPLOAD_FOLDER, params)
+                with stage('users'):
+                    register_file(session_id, description, filename)
+        if cached:
+            response = send_from_directory(UPLOAD_FOLDER, filename, mimetype=mimetype)
+            response.headers.update(headers)
+            return timed_response(response, timer, started, params=params, filename=filename, cached=True)
+        
+        with timer.activate(), stage('admission'):
+            ticket = admission.admit(render_cost(params))
+        final_path = os.path.join(UPLOAD_FOLDER, filename)
+        part_path = f'{final_path}.{uuid.uuid4().hex}.part'
+        chunks = generator.iter_audio_bytes(**params)
+        path, method = request.path, request.method
+        
+        def stream():
+            # Те же байты пишутся в файл; недописанный файл удаляется
+            done = False
+            written = 0
+            try:
+                with metrics.in_flight('stream'), open(part_path, 'wb') as f:
+                    while True:
+                        # Таймер включается только на время шага: между шагами управление у сервера
+                        with timer.activate():
+                            chunk = next(chunks, None)
+                            if chunk is None:
+                                break
+                            with stage('write'):
+                                f.write(chunk)
+                            written += len(chunk)
+                        yield chunk
+                with timer.activate():
+                    with stage('rename'):
+                        os.replace(part_path, final_path)
+                    with stage('midi'):
+                        generator.write_midi(UPLOAD_FOLDER, params)
+                    done = True
+                    metrics.observe_render('stream', params, time.perf_counter() - started, written)
+                    with stage('users'):
+                        register_file(session_id, description, filename)
+            finally:
+                chunks.close()
+                if not done and os.path.exists(part_path):
+                    os.remove(part_path)
+                # Заголовки уже ушли — полная раскладка только в журнале
+                request_log.append(route=path, method=method, status=200 if done else 499,
+                                   total=round(time.perf_counter() - started, 4), stages=timer.snapshot(),
+                                   params=params, filename=filename, cached=False, streamed=True)
+        
+        # Размер известен заранее только у WAV
+        if params['audio_format'] == 'wav':
+            headers['Content-Length'] = str(generator.wav_size(params['length_min'], params['channels'],
+                                                               params['sample_rate']))
+        headers['Server-Timing'] = server_timing(timer.snapshot(), time.perf_counter() - started)
+        response = Response(stream_with_context(stream()), mimetype=mimetype, headers=headers)
+        # Бюджет освобождается, когда сервер закрывает ответ — даже если поток не начался
+        response.call_on_close(lambda: admission.release(ticket))
+        return response
+    except Overloaded as e:
+        return timed_response(overloaded_response(e), timer, started, error=str(e))
+    except Exception as e:
+        print(f"Ошибка генерации: {e}")
+        response = jsonify({'success': False, 'error': str(e)})
+        response.status_code = 500
+        return timed_response(response, timer, started, error=str(e))
 
 @app.route('/download/<filename>')
 def download(filename):
@@ -192,9 +445,8 @@ def logout(session_id):
             # ✅ ОЧИСТИТЬ ФАЙЛЫ ПРИ ЛОГАУТЕ
             session_files = users['sessions'][session_id].get('files', [])
             for file_info in session_files:
-                file_path = os.path.join(UPLOAD_FOLDER, file_info['filename'])
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+                if not file_in_use(users, file_info['filename'], session_id):
+                    remove_track(file_info['filename'])
             del users['sessions'][session_id]
             save_users(users)
         return jsonify({'success': True})
@@ -222,19 +474,138 @@ def delete_file(session_id, filename):
                 f for f in users['sessions'][session_id].get('files', [])
                 if f['filename'] != filename
             ]
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            if not file_in_use(users, filename, session_id):
+                remove_track(filename)
             save_users(users)
         return jsonify({'success': True})
     except:
         return jsonify({'success': False})
 
+# ⏳ ФОНОВЫЕ ЗАДАЧИ РЕНДЕРА
+job_store = JobStore('jobs')
+job_manager = JobManager(
+    job_store, generator, UPLOAD_FOLDER,
+    max_workers=int(os.environ.get('RENDER_WORKERS', 2)),
+    max_queued=int(os.environ.get('RENDER_MAX_QUEUED', 32)),
+    on_done=lambda job: register_file(job['session_id'], job['description'], job['filename']),
+    admission=admission,
+    cost=render_cost,
+    render_cache=render_cache
+)
+atexit.register(job_manager.shutdown)
+job_manager.resume()
+
+def job_fields(job):
+    """Поля задачи в ответах API"""
+    return {
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'filename': job['filename'],
+        'download_url': job.get('download_url'),
+        'midi_url': job.get('midi_url'),
+        'timings': job.get('timings'),
+        'render_time': job.get('render_time'),
+        'encode_time': job.get('encode_time'),
+        'error': job.get('error')
+    }
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    try:
+        data = request.json
+        session_id = request.headers.get('X-Session-ID') or data.get('session_id')
+        params = render_params(data)
+        
+        job = job_manager.submit(params, session_id, data.get('description', 'Новый трек'))
+        if job is None:
+            response = jsonify({'success': False, 'error': 'Очередь рендера переполнена, попробуйте позже'})
+            response.headers['Retry-After'] = '30'
+            return response, 429
+        
+        # Трек из кэша готов сразу — клиент не опрашивает статус, поля те же, что у job_status
+        return jsonify({
+            **job_fields(job),
+            'status_url': f"/api/jobs/{job['id']}",
+            'seed': params['seed']
+        }), 202
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        print(f"Ошибка постановки задачи: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = job_store.load(job_id) if re.fullmatch(r'[0-9a-f]{32}', job_id) else None
+    if job is None:
+        return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
+    
+    return jsonify(job_fields(job))
+
+# 📊 СТАТИСТИКА КЭША РЕНДЕРОВ
+@app.route('/api/render-cache')
+def render_cache_stats():
+    return jsonify({'success': True, **render_cache.stats(), 'notes': generator.note_cache.stats(),
+                    'envelopes': generator.envelopes.stats()})
+
+# 📈 МЕТРИКИ PROMETHEUS
+@app.after_request
+def count_request(response):
+    # Маршрут по шаблону, а не по пути: имена файлов не раздувают число меток
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('http_requests_total', labels={'route': route, 'method': request.method,
+                                               'status': str(response.status_code)})
+    metrics.cache_stats('render_cache', render_cache.stats())
+    metrics.cache_stats('note_cache', generator.note_cache.stats())
+    metrics.cache_stats('envelope_cache', generator.envelopes.stats())
+    # Очередь и отказы — свои у процесса; занятость общего бюджета считается при опросе /metrics
+    budget = admission.stats()
+    metrics.set_gauge('admission_waiting', budget['waiting'])
+    metrics.set_counter('admission_rejected_total', budget['rejected'])
+    metrics.flush()
+    return response
+
+def storage_stats():
+    size, count = 0, 0
+    for entry in os.scandir(UPLOAD_FOLDER):
+        if entry.is_file():
+            size += entry.stat().st_size
+            count += 1
+    return size, count
+
+@app.route('/metrics')
+def prometheus_metrics():
+    size, count = storage_stats()
+    sessions = load_users()['sessions']
+    now = datetime.now().timestamp()
+    jobs = [job['status'] for job in job_store.pending()]
+    budget = admission.stats()
+    gauges = [
+        ('storage_bytes', None, size, 'Размер static/files, байт'),
+        ('storage_files', None, count, 'Число файлов в static/files'),
+        ('sessions', {'state': 'active'}, sum(s['expires'] > now for s in sessions.values()), 'Сессии в users.json'),
+        ('sessions', {'state': 'expired'}, sum(s['expires'] <= now for s in sessions.values()), 'Сессии в users.json'),
+        ('render_jobs', {'status': 'queued'}, jobs.count('queued'), 'Фоновые задачи в очереди и в работе'),
+        ('render_jobs', {'status': 'running'}, jobs.count('running'), 'Фоновые задачи в очереди и в работе'),
+        *((f'admission_{name}', None, budget[name], 'Общий бюджет рендеров и его занятость')
+          for name in ('active', 'memory_mb', 'cpu_seconds', 'memory_budget_mb', 'cpu_budget_seconds'))
+    ]
+    body = metrics.render(gauges, caches=('render_cache', 'note_cache', 'envelope_cache'))
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 # 📥 СКАЧИВАНИЕ ФАЙЛА ПОЛЬЗОВАТЕЛЯ
 @app.route('/files/<filename>')
 def download_user_file(filename):
     return send_from_directory(UPLOAD_FOLDER, filename, as_attachment=True)
 
+# 🎹 MIDI ТРЕКА: те же ноты для DAW, несколько КБ вместо десятков МБ
+@app.route('/midi/<filename>')
+def download_midi(filename):
+    midi_filename = os.path.splitext(filename)[0] + '.mid'
+    return send_from_directory(UPLOAD_FOLDER, midi_filename, as_attachment=True, mimetype='audio/midi')
+
 # 📤 TILDA WEBHOOK
 @app.route('/api/webhook', methods=['POST'])
 def tilda_webhook():
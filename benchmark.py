@@ -0,0 +1,175 @@
+"""Бенчмарк движка: сетка жанр × инструмент × длина × темп.
+
+Для каждого случая — настенное время (лучшее из --repeat), коэффициент
+реального времени (секунды аудио на секунду CPU), пик памяти по tracemalloc
+и время по стадиям. Результат сохраняется в JSON; при --baseline сравнение
+с сохранённым прогоном и код выхода 1, если что-то стало хуже порога.
+
+    python benchmark.py --quick --output bench.json
+    python benchmark.py --baseline bench.json --threshold 0.2
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from music_generator import ProMusicGenerator, StageTimer, ENGINE_VERSION
+
+GRID = {
+    'genre': ['Поп', 'Рок', 'Ambient'],
+    'instrument': ['Электронные', 'Оркестровые'],
+    'length_min': [1, 3],
+    'tempo_bpm': [90, 140]
+}
+
+QUICK_GRID = {
+    'genre': ['Поп', 'Ambient'],
+    'instrument': ['Электронные'],
+    'length_min': [1],
+    'tempo_bpm': [120]
+}
+
+# Метрики для сравнения с базой: имя → больше значит хуже
+REGRESSION_METRICS = {'wall_time': True, 'peak_memory_mb': True, 'realtime_factor': False}
+
+
+def case_name(case):
+    return f"{case['genre']}/{case['instrument']}/{case['length_min']}min/{case['tempo_bpm']}bpm/{case['audio_format']}"
+
+
+def clear_caches(generator):
+    generator.note_cache.clear()
+    generator.envelopes.cache.clear()
+
+
+def run_case(generator, case, repeat, directory):
+    """Один случай сетки: repeat замеров времени и отдельный прогон под tracemalloc"""
+    path = os.path.join(directory, 'bench.' + case['audio_format'])
+    params = dict(case, seed=1)
+    audio_seconds = case['length_min'] * 60
+
+    best = None
+    for _ in range(repeat):
+        # Холодные кэши нот и огибающих: каждый прогон синтезирует всё заново
+        clear_caches(generator)
+        timer = StageTimer()
+        wall, cpu = time.perf_counter(), time.process_time()
+        with timer.activate():
+            stats = generator.render_file(path, **params)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if best is None or wall < best['wall_time']:
+            best = {
+                'wall_time': round(wall, 4),
+                'cpu_time': round(cpu, 4),
+                'realtime_factor': round(audio_seconds / max(cpu, 1e-9), 2),
+                'render_time': stats['render_time'],
+                'encode_time': stats['encode_time'],
+                'bytes': stats['bytes'],
+                'stages': timer.snapshot()
+            }
+
+    clear_caches(generator)
+    tracemalloc.start()
+    generator.render_file(path, **params)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best['peak_memory_mb'] = round(peak / 2 ** 20, 2)
+    return best
+
+
+def run(grid, repeat=3, audio_format='wav', segment_workers=1, stem_workers=None):
+    generator = ProMusicGenerator(stem_workers=stem_workers, segment_workers=segment_workers)
+    keys = list(grid)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for values in itertools.product(*(grid[key] for key in keys)):
+            case = dict(zip(keys, values), mood='Радость', audio_format=audio_format)
+            result = run_case(generator, case, repeat, directory)
+            results[case_name(case)] = dict(case, **result)
+            print(f"{case_name(case):50s} {result['wall_time']:8.3f} с  "
+                  f"x{result['realtime_factor']:<8} {result['peak_memory_mb']:8.1f} МБ")
+    return {
+        'engine_version': ENGINE_VERSION,
+        'created': time.time(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'stem_workers': generator.stem_workers,
+            'segment_workers': generator.segment_workers
+        },
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def compare(current, baseline, threshold):
+    """Регрессии относительно базы: список (случай, метрика, было, стало)"""
+    regressions = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for metric, higher_is_worse in REGRESSION_METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old if higher_is_worse else (old - new) / old
+            if change > threshold:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк движка ProMusicGenerator')
+    parser.add_argument('--quick', action='store_true', help='маленькая сетка для быстрой проверки')
+    parser.add_argument('--genres', type=parse_list)
+    parser.add_argument('--instruments', type=parse_list)
+    parser.add_argument('--lengths', type=lambda v: parse_list(v, int))
+    parser.add_argument('--tempos', type=lambda v: parse_list(v, int))
+    parser.add_argument('--format', default='wav', choices=['wav', 'flac'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--segment-workers', type=int, default=1)
+    parser.add_argument('--stem-workers', type=int)
+    parser.add_argument('--output', help='куда сохранить результат (JSON)')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.15, help='допустимое ухудшение, доля (0.15 = 15%%)')
+    args = parser.parse_args(argv)
+
+    grid = dict(QUICK_GRID if args.quick else GRID)
+    for key, value in (('genre', args.genres), ('instrument', args.instruments),
+                       ('length_min', args.lengths), ('tempo_bpm', args.tempos)):
+        if value:
+            grid[key] = value
+
+    current = run(grid, args.repeat, args.format, args.segment_workers, args.stem_workers)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, metric, old, new in regressions:
+            print(f'❌ {name}: {metric} {old} → {new}')
+        if regressions:
+            return 1
+        print(f'✅ Регрессий нет (порог {args.threshold:.0%})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
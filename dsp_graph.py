@@ -0,0 +1,393 @@
+import threading
+from collections import namedtuple
+
+import numpy as np
+from scipy.signal import lfilter
+
+# Контекст исполнения: pos — абсолютный сэмпл начала блока, ramp_step — шаг
+# автоматизации (1 / длина трека), freqs и level — для пачки нот
+Block = namedtuple('Block', ['pos', 'n', 'ramp_step', 'freqs', 'level'])
+Block.__new__.__defaults__ = (0.0, None, 1.0)
+
+
+class GraphError(ValueError):
+    """Ошибка в описании графа: неизвестный вход, цикл, несовпадение каналов"""
+
+
+class Node:
+    """Узел графа. process(block, inputs, out) возвращает массив результата.
+
+    channels — число каналов выхода (None — как у входа), arity — число входов
+    (None — любое), in_place — можно писать результат в буфер первого входа,
+    owns_output — узел сам создаёт выходной массив (out не выделяется).
+    """
+
+    arity = 1
+    channels = None
+    in_place = False
+    owns_output = False
+
+    def process(self, block, inputs, out):
+        raise NotImplementedError
+
+    def ramp(self, block, start, end, out):
+        """Линейная автоматизация по всему треку: start → end"""
+        offsets = np.arange(block.n, dtype=np.float32)
+        np.multiply(offsets, block.ramp_step, out=out)
+        out += np.float32(block.pos * block.ramp_step)
+        np.multiply(out, end - start, out=out)
+        out += start
+        return out
+
+
+class Bus(Node):
+    """Внешний вход графа: буфер подаётся в Plan.run по имени"""
+
+    arity = 0
+
+    def __init__(self, channels=1):
+        self.channels = channels
+
+
+class Oscillator(Node):
+    """Пачка нот из волновой таблицы: строка на каждую частоту block.freqs"""
+
+    arity = 0
+    channels = 1
+    owns_output = True
+
+    def __init__(self, bank, waveform, harmonics=(1,)):
+        self.bank = bank
+        self.table = bank.build(waveform, harmonics)
+
+    def process(self, block, inputs, out):
+        return self.bank.oscillate(self.table, block.freqs, block.n)
+
+
+class Envelope(Node):
+    """Умножение на огибающую curve(n), масштабированную громкостью ноты block.level"""
+
+    in_place = True
+
+    def __init__(self, curve):
+        self.curve = curve
+
+    def process(self, block, inputs, out):
+        env = self.curve(block.n) * np.float32(block.level)
+        return np.multiply(inputs[0], env, out=out)
+
+
+class Filter(Node):
+    """Однополюсный ФНЧ; у потокового (одномерного) сигнала состояние сохраняется между блоками"""
+
+    def __init__(self, cutoff, sample_rate):
+        a = float(np.exp(-2 * np.pi * cutoff / sample_rate))
+        self.b, self.a = [1 - a], [1, -a]
+        self.state = None
+
+    def process(self, block, inputs, out):
+        x = inputs[0]
+        if x.ndim == 1:
+            if self.state is None:
+                self.state = np.zeros(1)
+            y, self.state = lfilter(self.b, self.a, x, zi=self.state)
+        else:
+            y = lfilter(self.b, self.a, x, axis=-1)
+        np.copyto(out, y, casting='same_kind')
+        return out
+
+
+class Gain(Node):
+    """Постоянное усиление или линейная автоматизация gain → end по треку"""
+
+    in_place = True
+
+    def __init__(self, gain, end=None):
+        self.gain = gain
+        self.end = end
+
+    @property
+    def constant(self):
+        return self.end is None
+
+    def process(self, block, inputs, out):
+        if self.constant:
+            return np.multiply(inputs[0], np.float32(self.gain), out=out)
+        curve = self.ramp(block, self.gain, self.end, np.empty(block.n, dtype=np.float32))
+        # Стерео-поток (n, 2): кривая по строкам; у пачки нот (rows, n) — по столбцам
+        if inputs[0].ndim == 2 and block.freqs is None:
+            curve = curve[:, None]
+        return np.multiply(inputs[0], curve, out=out)
+
+
+class Pan(Node):
+    """Моно в стерео по закону постоянной мощности (-3 дБ в центре).
+
+    position — пара (начало, конец) по треку, от -1 (лево) до 1 (право);
+    у неподвижной панорамы усиления каналов — две константы.
+    """
+
+    channels = 2
+
+    def __init__(self, position=(0.0, 0.0)):
+        self.position = position
+
+    @staticmethod
+    def gains(position):
+        angle = (position + 1) * np.pi / 4
+        return float(np.cos(angle)), float(np.sin(angle))
+
+    def process(self, block, inputs, out):
+        x = inputs[0]
+        start, end = self.position
+        if start == end:
+            for ch, gain in enumerate(self.gains(start)):
+                np.multiply(x, np.float32(gain), out=out[:, ch])
+            return out
+        # Угол панорамы по треку, затем cos/sin — усиления левого и правого каналов
+        angle = self.ramp(block, (start + 1) * np.pi / 4, (end + 1) * np.pi / 4, np.empty(block.n, dtype=np.float32))
+        np.sin(angle, out=out[:, 1])
+        np.cos(angle, out=out[:, 0])
+        out *= x[:, None]
+        return out
+
+
+class Delay(Node):
+    """Линия задержки (эхо без обратной связи) с переносом хвоста между блоками"""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.line = np.zeros(samples, dtype=np.float32)
+
+    def process(self, block, inputs, out):
+        x = inputs[0]
+        joined = np.concatenate((self.line, x))
+        np.copyto(out, joined[:len(x)])
+        self.line = joined[len(x):]
+        return out
+
+
+class Mixer(Node):
+    """Сумма входов с весами (веса появляются при слиянии с узлами Gain)"""
+
+    arity = None
+    in_place = True
+
+    def __init__(self, weights=None):
+        self.weights = weights
+
+    def process(self, block, inputs, out):
+        weights = self.weights or [None] * len(inputs)
+        first, w = inputs[0], weights[0]
+        if w is None:
+            if out is not first:
+                np.copyto(out, first)
+        else:
+            np.multiply(first, np.float32(w), out=out)
+        for x, w in zip(inputs[1:], weights[1:]):
+            out += x if w is None else x * np.float32(w)
+        return out
+
+
+class Reverb(Node):
+    """Эффект-вставка: любой объект с process(x, out), например свёрточный ревербератор"""
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def process(self, block, inputs, out):
+        self.processor.process(inputs[0], out)
+        return out
+
+
+class Graph:
+    """Описание сигнального графа: узлы по именам и их входы"""
+
+    def __init__(self):
+        self.nodes = {}
+        self.inputs = {}
+
+    def add(self, name, node, *inputs):
+        if name in self.nodes:
+            raise GraphError(f'Узел {name} уже есть')
+        self.nodes[name] = node
+        self.inputs[name] = list(inputs)
+        return name
+
+    def consumers(self):
+        users = {name: [] for name in self.nodes}
+        for name, inputs in self.inputs.items():
+            for source in inputs:
+                users[source].append(name)
+        return users
+
+    def order(self):
+        """Топологический порядок; цикл — ошибка"""
+        order, state = [], {}
+
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise GraphError(f'Цикл в графе: {" → ".join(path + [name])}')
+            state[name] = 'visiting'
+            for source in self.inputs[name]:
+                visit(source, path + [name])
+            state[name] = 'done'
+            order.append(name)
+
+        for name in self.nodes:
+            visit(name, [])
+        return order
+
+    def validate(self, output):
+        """Проверка графа; возвращает число каналов каждого узла"""
+        if output not in self.nodes:
+            raise GraphError(f'Нет выходного узла {output}')
+        for name, inputs in self.inputs.items():
+            node = self.nodes[name]
+            for source in inputs:
+                if source not in self.nodes:
+                    raise GraphError(f'{name}: неизвестный вход {source}')
+            if node.arity is not None and len(inputs) != node.arity:
+                raise GraphError(f'{name}: ожидается входов {node.arity}, получено {len(inputs)}')
+            if node.arity is None and not inputs:
+                raise GraphError(f'{name}: нет входов')
+
+        channels = {}
+        for name in self.order():
+            node, inputs = self.nodes[name], self.inputs[name]
+            in_channels = {channels[source] for source in inputs}
+            if len(in_channels) > 1:
+                raise GraphError(f'{name}: входы с разным числом каналов')
+            if isinstance(node, Pan) and in_channels != {1}:
+                raise GraphError(f'{name}: панорама принимает только моно')
+            channels[name] = node.channels or (in_channels.pop() if in_channels else 1)
+        return channels
+
+    def fuse(self, output):
+        """Слияние постоянных Gain: цепочки перемножаются, Gain перед Mixer уходит в его веса"""
+        users = self.consumers()
+        for name in list(self.nodes):
+            node = self.nodes[name]
+            if not isinstance(node, Gain) or not node.constant or name == output:
+                continue
+            (source,) = self.inputs[name]
+            targets = users[name]
+            if len(targets) != 1:
+                continue
+            target = self.nodes[targets[0]]
+            if isinstance(target, Gain) and target.constant:
+                target.gain *= node.gain
+            elif isinstance(target, Mixer):
+                inputs = self.inputs[targets[0]]
+                weights = target.weights or [None] * len(inputs)
+                i = inputs.index(name)
+                weights[i] = node.gain if weights[i] is None else weights[i] * node.gain
+                target.weights = weights
+            else:
+                continue
+            self.inputs[targets[0]] = [source if s == name else s for s in self.inputs[targets[0]]]
+            users[source] = [targets[0] if u == name else u for u in users[source]]
+            del self.nodes[name], self.inputs[name], users[name]
+
+    def compile(self, output='out'):
+        self.validate(output)
+        self.fuse(output)
+        return Plan(self, output)
+
+
+class Plan:
+    """Скомпилированный граф: порядок узлов и слоты буферов с учётом времени жизни.
+
+    Буфер значения освобождается после последнего потребителя и переиспользуется;
+    узлы in_place пишут прямо во вход, если он больше никому не нужен.
+    Буферы у каждого потока свои.
+    """
+
+    def __init__(self, graph, output):
+        self.nodes = graph.nodes
+        self.inputs = graph.inputs
+        self.output = output
+        self.channels = graph.validate(output)
+
+        # Только узлы, от которых зависит выход
+        needed, stack = set(), [output]
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.inputs[name])
+        self.order = [name for name in graph.order() if name in needed]
+
+        last_use = {}
+        for step, name in enumerate(self.order):
+            for source in self.inputs[name]:
+                last_use[source] = step
+        last_use[output] = len(self.order)
+
+        # slot[name] — номер буфера; 'in' — пишет в буфер первого входа; None — свой/внешний
+        self.slots = {}
+        self.slot_channels = []
+        free = {}
+        owner = {}
+        for step, name in enumerate(self.order):
+            node = self.nodes[name]
+            inputs = self.inputs[name]
+            if isinstance(node, Bus) or node.owns_output:
+                self.slots[name] = None
+                owner[name] = None if isinstance(node, Bus) else name
+            elif (node.in_place and inputs and last_use[inputs[0]] == step
+                    and inputs.count(inputs[0]) == 1 and owner.get(inputs[0]) is not None
+                    and self.channels[inputs[0]] == self.channels[name]):
+                self.slots[name] = 'in'
+                owner[name] = owner[inputs[0]]
+            else:
+                ch = self.channels[name]
+                if free.get(ch):
+                    slot = free[ch].pop()
+                else:
+                    slot = len(self.slot_channels)
+                    self.slot_channels.append(ch)
+                self.slots[name] = slot
+                owner[name] = slot
+            # Освобождение буферов, чьё время жизни закончилось на этом шаге
+            for source in set(inputs):
+                if last_use[source] == step and isinstance(owner.get(source), int):
+                    if owner[source] != owner[name]:
+                        free.setdefault(self.slot_channels[owner[source]], []).append(owner[source])
+        self.local = threading.local()
+
+    def buffers(self, n, rows=None):
+        """Буферы слотов для блока длиной n (у пачки нот — rows строк)"""
+        pool = getattr(self.local, 'pool', None)
+        if pool is None:
+            pool = self.local.pool = [np.empty(0, dtype=np.float32) for _ in self.slot_channels]
+        views = []
+        for i, ch in enumerate(self.slot_channels):
+            shape = (rows, n) if rows else ((n, ch) if ch > 1 else (n,))
+            size = int(np.prod(shape))
+            if len(pool[i]) < size:
+                pool[i] = np.empty(size, dtype=np.float32)
+            views.append(pool[i][:size].reshape(shape))
+        return views
+
+    def run(self, block, **buses):
+        """Исполнение плана; результат живёт до следующего вызова в этом потоке"""
+        rows = len(block.freqs) if block.freqs is not None else None
+        slots = self.buffers(block.n, rows)
+        values = {}
+        for name in self.order:
+            node, slot = self.nodes[name], self.slots[name]
+            if isinstance(node, Bus):
+                values[name] = buses[name]
+                continue
+            inputs = [values[source] for source in self.inputs[name]]
+            if slot == 'in':
+                out = inputs[0]
+            elif slot is None:
+                out = None
+            else:
+                out = slots[slot]
+            values[name] = node.process(block, inputs, out)
+        return values[self.output]
@@ -0,0 +1,423 @@
+import hashlib
+import struct
+import numpy as np
+
+# Коды частоты дискретизации в заголовке кадра (остальные берутся из STREAMINFO)
+SAMPLE_RATE_CODES = {
+    88200: 1, 176400: 2, 192000: 3, 8000: 4, 16000: 5, 22050: 6,
+    24000: 7, 32000: 8, 44100: 9, 48000: 10, 96000: 11
+}
+
+# Назначение каналов: независимые, left/side, side/right, mid/side
+CHANNELS_INDEPENDENT = 1
+CHANNELS_LEFT_SIDE = 8
+CHANNELS_SIDE_RIGHT = 9
+CHANNELS_MID_SIDE = 10
+
+MAX_RICE_PARAM = 14
+MAX_PARTITION_ORDER = 8
+FIXED_ORDERS = 5
+
+
+def _crc_table(poly, width):
+    table = np.zeros(256, dtype=np.int64)
+    top, mask = 1 << (width - 1), (1 << width) - 1
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & top else crc << 1
+        table[byte] = crc & mask
+    return table
+
+
+CRC8_TABLE = _crc_table(0x07, 8).tolist()
+CRC16_TABLE = _crc_table(0x8005, 16)
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+class Crc16:
+    """CRC-16 FLAC (0x8005) сразу для пачки кадров.
+
+    CRC линеен: кадр режется на куски по 16 байт, CRC кусков считается
+    таблицами «байт на расстоянии d от конца», затем куски попарно
+    сворачиваются деревом: crc(AB) = сдвиг(crc(A), |B|) ^ crc(B).
+    """
+
+    CHUNK = 16
+
+    def __init__(self):
+        def zero_byte(crc):
+            return ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[crc >> 8]
+
+        # by_distance[d][b] — CRC байта b, за которым идут d нулевых байт
+        self.by_distance = np.zeros((self.CHUNK, 256), dtype=np.int64)
+        self.by_distance[0] = CRC16_TABLE
+        for d in range(1, self.CHUNK):
+            self.by_distance[d] = zero_byte(self.by_distance[d - 1])
+
+        # Сдвиг CRC на 16·2^level нулевых байт: таблицы для старшего и младшего байта
+        values = np.arange(256, dtype=np.int64)
+        hi, lo = values << 8, values.copy()
+        for _ in range(self.CHUNK):
+            hi, lo = zero_byte(hi), zero_byte(lo)
+        self.shifts = [(hi, lo)]
+        for _ in range(24):
+            hi, lo = self.shifts[-1]
+            self.shifts.append((self._shift(hi, hi, lo), self._shift(lo, hi, lo)))
+
+    @staticmethod
+    def _shift(crc, hi, lo):
+        return hi[crc >> 8] ^ lo[crc & 0xFF]
+
+    def compute(self, frames):
+        """CRC каждого кадра из списка bytes"""
+        longest = max(len(frame) for frame in frames)
+        chunks = 1
+        while chunks * self.CHUNK < longest:
+            chunks *= 2
+        # Ведущие нули не меняют CRC с нулевым начальным значением
+        data = np.zeros((len(frames), chunks * self.CHUNK), dtype=np.uint8)
+        for i, frame in enumerate(frames):
+            data[i, data.shape[1] - len(frame):] = np.frombuffer(frame, dtype=np.uint8)
+
+        data = data.reshape(len(frames), chunks, self.CHUNK)
+        crc = np.zeros((len(frames), chunks), dtype=np.int64)
+        for pos in range(self.CHUNK):
+            crc ^= self.by_distance[self.CHUNK - 1 - pos][data[:, :, pos]]
+
+        level = 0
+        while crc.shape[1] > 1:
+            hi, lo = self.shifts[level]
+            crc = self._shift(crc[:, 0::2], hi, lo) ^ crc[:, 1::2]
+            level += 1
+        return crc[:, 0].tolist()
+
+
+def utf8_number(value):
+    """Номер кадра в расширенном UTF-8, как требует FLAC"""
+    if value < 0x80:
+        return bytes([value])
+    length = 2
+    while value >= 1 << (5 * length + 1):
+        length += 1
+    out = []
+    for _ in range(length - 1):
+        out.append(0x80 | (value & 0x3F))
+        value >>= 6
+    out.append(((0xFF00 >> length) & 0xFF) | value)
+    return bytes(reversed(out))
+
+
+def zigzag(residual):
+    """Знаковый остаток в беззнаковый: 0, -1, 1, -2 … → 0, 1, 2, 3 …"""
+    return (residual << 1) ^ (residual >> 63)
+
+
+def rice_partitions(residual, order, block_size):
+    """Лучшее разбиение остатка на Rice-разделы для пачки кадров.
+
+    residual — (F, block_size - order). Возвращает оценку стоимости в битах (F,),
+    порядок разбиения (F,) и параметры Rice по уровням {level: (F, 2^level)}.
+    Параметр раздела выводится из суммы значений: при k бит на остаток
+    длина ≈ N·(k + 1) + S / 2^k, что минимально около k = log2(S·ln2 / N).
+    """
+    frames = residual.shape[0]
+    u = np.empty((frames, block_size), dtype=np.int64)
+    u[:, :order] = 0
+    np.left_shift(residual, 1, out=u[:, order:])
+    u[:, order:] ^= residual >> 63
+
+    max_level = 0
+    while (max_level < MAX_PARTITION_ORDER and block_size % (2 << max_level) == 0
+           and (block_size >> (max_level + 1)) > order):
+        max_level += 1
+
+    # Суммы по самым мелким разделам, затем слияние соседних
+    sums = u.reshape(frames, 1 << max_level, -1).sum(axis=2).astype(np.float64)
+
+    best_cost = np.full(frames, np.inf)
+    best_level = np.zeros(frames, dtype=np.int64)
+    params = {}
+    for level in range(max_level, -1, -1):
+        counts = np.full(1 << level, block_size >> level, dtype=np.float64)
+        counts[0] -= order
+        guess = np.floor(np.log2(np.maximum(sums * np.log(2) / counts, 1)))
+        costs, ks = None, None
+        for k in (guess, guess + 1):
+            k = np.minimum(k, MAX_RICE_PARAM)
+            cost = counts * (k + 1) + sums / 2 ** k
+            if costs is None:
+                costs, ks = cost, k
+            else:
+                better = cost < costs
+                costs, ks = np.where(better, cost, costs), np.where(better, k, ks)
+        params[level] = ks.astype(np.int64)
+        total = costs.sum(axis=1) + 4 * (1 << level)
+        better = total < best_cost
+        best_cost[better] = total[better]
+        best_level[better] = level
+        if level:
+            sums = sums[:, 0::2] + sums[:, 1::2]
+    return best_cost.astype(np.int64) + 6, best_level, params
+
+
+def lpc_coefficients(signal, order, precision):
+    """Квантованные LPC-коэффициенты (Левинсон–Дарбин по кадрам)"""
+    frames, n = signal.shape
+    window = np.hanning(n + 2)[1:-1]
+    x = signal * window
+    autoc = np.stack([(x[:, lag:] * x[:, :n - lag]).sum(axis=1) for lag in range(order + 1)], axis=1)
+    autoc[:, 0] *= 1.0 + 1e-9
+    autoc[:, 0] += 1e-9
+
+    a = np.zeros((frames, order))
+    err = autoc[:, 0].copy()
+    for i in range(order):
+        acc = autoc[:, i + 1] - (a[:, :i] * autoc[:, i:0:-1]).sum(axis=1)
+        reflection = acc / err
+        a_prev = a[:, :i].copy()
+        a[:, i] = reflection
+        a[:, :i] = a_prev - reflection[:, None] * a_prev[:, ::-1]
+        err *= 1 - reflection ** 2
+        err = np.maximum(err, 1e-12)
+
+    peak = np.abs(a).max(axis=1)
+    log2_peak = np.floor(np.log2(np.maximum(peak, 1e-12))).astype(np.int64)
+    shift = np.clip(precision - 2 - log2_peak, 0, 15)
+    limit = 1 << (precision - 1)
+    coefs = np.clip(np.round(a * (2.0 ** shift)[:, None]), -limit, limit - 1).astype(np.int64)
+    return coefs, shift
+
+
+def lpc_residual(signal, coefs, shift):
+    order = coefs.shape[1]
+    n = signal.shape[1]
+    prediction = np.zeros((signal.shape[0], n - order), dtype=np.int64)
+    for j in range(order):
+        prediction += coefs[:, j:j + 1] * signal[:, order - 1 - j:n - 1 - j]
+    return signal[:, order:] - (prediction >> shift[:, None])
+
+
+class Subframes:
+    """Лучший подкадр для каждого кадра пачки: constant/verbatim/fixed/LPC"""
+
+    def __init__(self, signal, bps, lpc_order, lpc_precision):
+        frames, n = signal.shape
+        self.signal, self.bps = signal, bps
+        self.candidates = []
+
+        self.cost = np.full(frames, n * bps + 8, dtype=np.int64)
+        self.kind = np.full(frames, -1)
+
+        for order in range(min(FIXED_ORDERS, n)):
+            residual = np.diff(signal, order, axis=1)
+            cost, level, params = rice_partitions(residual, order, n)
+            self._offer(cost + 8 + order * bps, ('fixed', order, residual, level, params, None, None))
+
+        if lpc_order and n > 4 * lpc_order:
+            coefs, shift = lpc_coefficients(signal.astype(np.float64), lpc_order, lpc_precision)
+            residual = lpc_residual(signal, coefs, shift)
+            # Остаток должен помещаться в 32 бита со знаком
+            fits = np.abs(residual).max(axis=1) < (1 << 30)
+            cost, level, params = rice_partitions(np.where(fits[:, None], residual, 0), lpc_order, n)
+            cost = np.where(fits, cost, np.iinfo(np.int64).max)
+            header = 8 + lpc_order * bps + 4 + 5 + lpc_order * lpc_precision
+            self._offer(cost + header, ('lpc', lpc_order, residual, level, params, coefs, shift), lpc_precision)
+
+        constant = (signal == signal[:, :1]).all(axis=1)
+        self.cost[constant] = 8 + bps
+        self.kind[constant] = -2
+
+    def _offer(self, cost, candidate, precision=None):
+        better = cost < self.cost
+        self.cost[better] = cost[better]
+        self.kind[better] = len(self.candidates)
+        self.candidates.append(candidate + (precision,))
+
+    def fields(self, f, n):
+        """Поля (значение, ширина в битах) подкадра кадра f"""
+        signal, bps = self.signal[f], self.bps
+        mask = (1 << bps) - 1
+        if self.kind[f] == -2:
+            return [np.array([0x00, signal[0] & mask]), np.array([8, bps])]
+        if self.kind[f] == -1:
+            return [np.concatenate(([0x02], signal & mask)), np.concatenate(([8], np.full(n, bps)))]
+
+        kind, order, residual, level, params, coefs, shift, precision = self.candidates[self.kind[f]]
+        values = [signal[:order] & mask]
+        widths = [np.full(order, bps)]
+        if kind == 'fixed':
+            head = 0x10 | (order << 1)
+        else:
+            head = 0x40 | ((order - 1) << 1)
+            values.append([precision - 1, shift[f]])
+            widths.append([4, 5])
+            values.append(coefs[f] & ((1 << precision) - 1))
+            widths.append(np.full(order, precision))
+
+        lvl = level[f]
+        ks = params[lvl][f]
+        part_len = n >> lvl
+        counts = np.full(1 << lvl, part_len)
+        counts[0] -= order
+        k = np.repeat(ks, counts)
+        u = zigzag(residual[f])
+        # Rice: q нулей, единица и k младших бит — одно поле ширины q + 1 + k
+        rice_values = (1 << k) | (u & ((1 << k) - 1))
+        rice_widths = (u >> k) + 1 + k
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        rice_values = np.insert(rice_values, starts, ks)
+        rice_widths = np.insert(rice_widths, starts, 4)
+
+        values = [[head]] + values + [[lvl]] + [rice_values]
+        widths = [[8]] + widths + [[6]] + [rice_widths]
+        return [np.concatenate([np.asarray(v, dtype=np.int64) for v in values]),
+                np.concatenate([np.asarray(w, dtype=np.int64) for w in widths])]
+
+
+def pack_bits(values, widths):
+    """Упаковка полей (старший бит первым) в байты.
+
+    Поля не пересекаются, а значащих бит у каждого не больше 32 (длинные
+    Rice-поля — это ведущие нули), поэтому поле сдвигается к концу своего
+    последнего байта и раскладывается по байтам сложением через bincount.
+    """
+    ends = np.cumsum(widths)
+    n_bytes = (int(ends[-1]) + 7) // 8
+    last_byte = (ends + 7) // 8 - 1
+    shifted = values << ((last_byte + 1) * 8 - ends)
+    out = np.zeros(n_bytes)
+    index = last_byte
+    while True:
+        nonzero = shifted != 0
+        if not nonzero.any():
+            break
+        out += np.bincount(index[nonzero], weights=shifted[nonzero] & 0xFF, minlength=n_bytes)
+        shifted = shifted[nonzero] >> 8
+        index = index[nonzero] - 1
+    return out.astype(np.uint8).tobytes()
+
+
+class FlacEncoder:
+    """Потоковый FLAC-кодер на NumPy: 16 бит, кадры фиксированного размера.
+
+    encode() принимает int16 (n, channels) и возвращает байты готовых кадров,
+    flush() дописывает последний неполный кадр. head() — маркер fLaC и
+    STREAMINFO; после flush() он содержит MD5 и размеры кадров.
+    """
+
+    def __init__(self, sample_rate, channels, block_size=4096, total_samples=0,
+                 lpc_order=8, lpc_precision=12, batch_frames=16):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.block_size = block_size
+        self.total_samples = total_samples
+        self.lpc_order = lpc_order
+        self.lpc_precision = lpc_precision
+        self.batch_frames = batch_frames
+        self.pending = np.zeros((0, channels), dtype=np.int16)
+        self.md5 = hashlib.md5()
+        self.samples = 0
+        self.frame_number = 0
+        self.min_frame = self.max_frame = 0
+        self.finished = False
+        self.crc16 = Crc16()
+
+    def head(self):
+        """fLaC + STREAMINFO (до flush() без MD5 и размеров кадров)"""
+        total = self.samples if self.finished else self.total_samples
+        md5 = self.md5.digest() if self.finished else bytes(16)
+        info = struct.pack('>HH', self.block_size, self.block_size)
+        info += self.min_frame.to_bytes(3, 'big') + self.max_frame.to_bytes(3, 'big')
+        packed = (self.sample_rate << 44) | ((self.channels - 1) << 41) | (15 << 36) | total
+        info += packed.to_bytes(8, 'big') + md5
+        return b'fLaC' + bytes([0x80, 0, 0, len(info)]) + info
+
+    def encode(self, pcm):
+        pcm = np.asarray(pcm, dtype='<i2').reshape(-1, self.channels)
+        self.md5.update(pcm.tobytes())
+        self.samples += len(pcm)
+        self.pending = np.concatenate((self.pending, pcm))
+        frames = len(self.pending) // self.block_size
+        if not frames:
+            return b''
+        data = self.pending[:frames * self.block_size]
+        self.pending = self.pending[frames * self.block_size:]
+        return self.encode_frames(data.reshape(frames, self.block_size, self.channels))
+
+    def flush(self):
+        data = b''
+        if len(self.pending):
+            data = self.encode_frames(self.pending[None])
+            self.pending = self.pending[:0]
+        self.finished = True
+        return data
+
+    def encode_frames(self, blocks):
+        out = []
+        for b in range(0, len(blocks), self.batch_frames):
+            out.append(self.encode_batch(blocks[b:b + self.batch_frames].astype(np.int64)))
+        return b''.join(out)
+
+    def encode_batch(self, blocks):
+        n_frames, n, _ = blocks.shape
+        analyze = lambda signal, bps: Subframes(signal, bps, self.lpc_order, self.lpc_precision)
+
+        if self.channels == 2:
+            left, right = blocks[:, :, 0], blocks[:, :, 1]
+            side = left - right
+            subs = {'L': analyze(left, 16), 'R': analyze(right, 16),
+                    'S': analyze(side, 17), 'M': analyze((left + right) >> 1, 16)}
+            layouts = [
+                (CHANNELS_INDEPENDENT, ('L', 'R')), (CHANNELS_LEFT_SIDE, ('L', 'S')),
+                (CHANNELS_SIDE_RIGHT, ('S', 'R')), (CHANNELS_MID_SIDE, ('M', 'S'))
+            ]
+            costs = np.stack([subs[a].cost + subs[b].cost for _, (a, b) in layouts])
+            choice = costs.argmin(axis=0)
+        else:
+            subs = {str(c): analyze(blocks[:, :, c], 16) for c in range(self.channels)}
+            layouts = [(self.channels - 1, tuple(str(c) for c in range(self.channels)))]
+            choice = np.zeros(n_frames, dtype=np.int64)
+
+        frames, field_values, field_widths, frame_bytes = [], [], [], []
+        for f in range(n_frames):
+            assignment, names = layouts[choice[f]]
+            header = self.frame_header(assignment, n)
+            values = [np.frombuffer(header, dtype=np.uint8).astype(np.int64)]
+            widths = [np.full(len(header), 8, dtype=np.int64)]
+            for name in names:
+                v, w = subs[name].fields(f, n)
+                values.append(v)
+                widths.append(w)
+            bits = sum(int(w.sum()) for w in widths)
+            values.append(np.zeros(1, dtype=np.int64))
+            widths.append(np.array([-bits % 8]))
+            field_values.extend(values)
+            field_widths.extend(widths)
+            frame_bytes.append((bits + 7) // 8)
+
+        packed = pack_bits(np.concatenate(field_values), np.concatenate(field_widths))
+        offsets = np.concatenate(([0], np.cumsum(frame_bytes)))
+        frames = [packed[offsets[i]:offsets[i + 1]] for i in range(n_frames)]
+        crcs = self.crc16.compute(frames)
+
+        out = []
+        for frame, crc in zip(frames, crcs):
+            size = len(frame) + 2
+            self.min_frame = size if not self.min_frame else min(self.min_frame, size)
+            self.max_frame = max(self.max_frame, size)
+            out.append(frame + crc.to_bytes(2, 'big'))
+        return b''.join(out)
+
+    def frame_header(self, assignment, n):
+        rate_code = SAMPLE_RATE_CODES.get(self.sample_rate, 0)
+        header = bytes([0xFF, 0xF8, (0x7 << 4) | rate_code, (assignment << 4) | (0x4 << 1)])
+        header += utf8_number(self.frame_number) + (n - 1).to_bytes(2, 'big')
+        self.frame_number += 1
+        return header + bytes([crc8(header)])
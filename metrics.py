@@ -0,0 +1,278 @@
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+
+# Границы гистограммы длительности рендера, секунды
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+PREFIX = 'ruzvuk_'
+
+# Счётчики и гистограммы завершившихся процессов, сложенные в один файл
+ARCHIVE_NAME = 'archive.json'
+
+# Каталог общий для воркеров gunicorn и процессов рендера
+DEFAULT_METRICS_DIR = os.environ.get('METRICS_DIR', 'metrics')
+
+
+def length_bucket(length_min):
+    for limit, label in ((2, '1-2'), (5, '3-5'), (15, '6-15')):
+        if length_min <= limit:
+            return label
+    return '16-60'
+
+
+def tempo_bucket(tempo_bpm):
+    if tempo_bpm < 90:
+        return 'slow'
+    return 'medium' if tempo_bpm < 130 else 'fast'
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def load(path):
+    """Содержимое файла метрик; None — файла нет или он повреждён"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write(path, data):
+    """Атомарная запись: читатели не увидят половину файла"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def dump(counters, gauges, histograms):
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'gauges': [[name, labels, value] for (name, labels), value in gauges.items()],
+        'histograms': [[name, labels, hist] for (name, labels), hist in histograms.items()]
+    }
+
+
+def merge(files):
+    """Сумма содержимого файлов метрик (None пропускаются)"""
+    counters, gauges, histograms = {}, {}, {}
+    for data in files:
+        if data is None:
+            continue
+        for metric, labels, value in data['counters']:
+            key = (metric, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, value in data['gauges']:
+            key = (metric, tuple(map(tuple, labels)))
+            gauges[key] = gauges.get(key, 0) + value
+        for metric, labels, hist in data['histograms']:
+            key = (metric, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, {'buckets': [0] * len(hist['buckets']), 'sum': 0.0,
+                                                'count': 0, 'bounds': hist['bounds']})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], hist['buckets'])]
+            total['sum'] += hist['sum']
+            total['count'] += hist['count']
+    return counters, gauges, histograms
+
+
+class Metrics:
+    """Метрики процесса в файле <directory>/<pid>.json; /metrics складывает все файлы.
+
+    Так счётчики видят все воркеры gunicorn и процессы рендера. Файл умершего
+    процесса при опросе переносится в archive.json: его счётчики и гистограммы
+    сохраняются, gauge (например, рендеры в работе) отбрасываются. Число
+    файлов не растёт с перезапусками, а новый процесс с тем же pid не
+    затирает значения старого.
+    """
+
+    def __init__(self, directory=DEFAULT_METRICS_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def _check_fork(self):
+        # После fork у дочернего процесса свой файл и свои значения;
+        # файл с тем же pid остался от умершего процесса — он уходит в архив
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.reset()
+            with self.locked():
+                self.archive(self.path(self.pid))
+
+    def path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    @contextmanager
+    def locked(self):
+        """Блокировка каталога между процессами: каждый файл попадает в архив один раз"""
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def archive(self, path):
+        """Счётчики и гистограммы файла умершего процесса — в архив, файл удаляется (под locked)"""
+        data = load(path)
+        if data is not None:
+            archive_path = os.path.join(self.directory, ARCHIVE_NAME)
+            counters, _, histograms = merge([load(archive_path), data])
+            write(archive_path, dump(counters, {}, histograms))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def inc(self, name, value=1, labels=None):
+        with self.lock:
+            self._check_fork()
+            key = self.key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_counter(self, name, value, labels=None):
+        """Абсолютное значение счётчика, который процесс ведёт сам (например, попадания кэша)"""
+        with self.lock:
+            self._check_fork()
+            self.counters[self.key(name, labels)] = value
+
+    def add_gauge(self, name, value, labels=None):
+        with self.lock:
+            self._check_fork()
+            key = self.key(name, labels)
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=None):
+        with self.lock:
+            self._check_fork()
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, labels=None, buckets=DURATION_BUCKETS):
+        with self.lock:
+            self._check_fork()
+            key = self.key(name, labels)
+            hist = self.histograms.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0,
+                                                    'bounds': list(buckets)})
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    @contextmanager
+    def in_flight(self, route):
+        """Рендер в работе: gauge виден остальным процессам сразу"""
+        self.add_gauge('renders_in_flight', 1, {'route': route})
+        self.flush()
+        try:
+            yield
+        finally:
+            self.add_gauge('renders_in_flight', -1, {'route': route})
+            self.flush()
+
+    def observe_render(self, route, params, seconds, nbytes=0):
+        """Длительность рендера по корзинам длины и темпа и записанные байты"""
+        labels = {'route': route, 'length': length_bucket(params['length_min']),
+                  'tempo': tempo_bucket(params['tempo_bpm'])}
+        self.observe('render_duration_seconds', seconds, labels)
+        if nbytes:
+            self.inc('bytes_written_total', nbytes, {'format': params.get('audio_format', 'wav')})
+
+    def cache_stats(self, name, stats):
+        self.set_counter(f'{name}_lookups_total', stats['hits'], {'result': 'hit'})
+        self.set_counter(f'{name}_lookups_total', stats['misses'], {'result': 'miss'})
+
+    def flush(self):
+        """Атомарная запись значений процесса в его файл.
+
+        Запись под блокировкой: у потоков процесса общий временный файл, и
+        более старый снимок не должен заменить более новый.
+        """
+        with self.lock:
+            self._check_fork()
+            write(self.path(self.pid), dump(self.counters, self.gauges, self.histograms))
+
+    def collect(self):
+        """Сумма по архиву и файлам живых процессов; файлы умерших уходят в архив"""
+        with self.locked():
+            files = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json') or not name[:-5].isdigit():
+                    continue
+                path = os.path.join(self.directory, name)
+                if pid_alive(int(name[:-5])):
+                    files.append(load(path))
+                else:
+                    self.archive(path)
+            files.append(load(os.path.join(self.directory, ARCHIVE_NAME)))
+        return merge(files)
+
+    def render(self, extra_gauges=(), caches=()):
+        """Текстовый формат Prometheus.
+
+        extra_gauges — (имя, метки, значение, описание), считаются при опросе;
+        для каждого кэша из caches добавляется доля попаданий по всем процессам.
+        """
+        counters, gauges, histograms = self.collect()
+        extra_gauges = list(extra_gauges)
+        for name in caches:
+            lookups = {labels: value for (metric, labels), value in counters.items()
+                       if metric == f'{name}_lookups_total'}
+            hits = sum(value for labels, value in lookups.items() if ('result', 'hit') in labels)
+            total = sum(lookups.values())
+            extra_gauges.append((f'{name}_hit_ratio', None, hits / total if total else 0.0,
+                                 'Доля попаданий в кэш по всем процессам'))
+        descriptions = {}
+        for metric, labels, value, text in extra_gauges:
+            gauges[(metric, tuple(sorted((labels or {}).items())))] = value
+            descriptions[metric] = text
+
+        lines = []
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for metric in sorted({metric for metric, _ in values}):
+                if metric in descriptions:
+                    lines.append(f'# HELP {PREFIX}{metric} {descriptions[metric]}')
+                lines.append(f'# TYPE {PREFIX}{metric} {kind}')
+                for (name, labels), value in sorted(values.items()):
+                    if name == metric:
+                        lines.append(f'{PREFIX}{metric}{label_text(labels)} {value}')
+
+        for metric in sorted({metric for metric, _ in histograms}):
+            lines.append(f'# TYPE {PREFIX}{metric} histogram')
+            for (name, labels), hist in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                for bound, count in zip(hist['bounds'], hist['buckets']):
+                    lines.append(f'{PREFIX}{metric}_bucket{label_text(labels + (("le", str(bound)),))} {count}')
+                lines.append(f'{PREFIX}{metric}_bucket{label_text(labels + (("le", "+Inf"),))} {hist["count"]}')
+                lines.append(f'{PREFIX}{metric}_sum{label_text(labels)} {hist["sum"]}')
+                lines.append(f'{PREFIX}{metric}_count{label_text(labels)} {hist["count"]}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,94 @@
+import math
+import struct
+
+# Ударные General MIDI (канал 10)
+DRUM_NOTES = {
+    'kick': 36, 'snare': 38, 'hat': 42, 'open_hat': 46,
+    'tom_low': 45, 'tom_mid': 47, 'tom_high': 50
+}
+DRUM_CHANNEL = 9
+
+
+def var_len(value):
+    """Число переменной длины: по 7 бит, старший бит — «дальше ещё байт»"""
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def midi_pitch(freq):
+    return min(max(int(round(69 + 12 * math.log2(freq / 440.0))), 0), 127)
+
+
+def velocity(volume, full_scale=0.5):
+    """Громкость события движка в velocity 1–127"""
+    return min(max(int(round(127 * volume / full_scale)), 1), 127)
+
+
+class MidiFile:
+    """Standard MIDI File, тип 1: дорожка темпа и по дорожке на каждый стем"""
+
+    def __init__(self, tempo_bpm, ticks_per_beat=480, beats_per_bar=4):
+        self.tempo_bpm = tempo_bpm
+        self.ticks_per_beat = ticks_per_beat
+        self.beats_per_bar = beats_per_bar
+        self.tracks = []
+
+    def ticks(self, seconds):
+        return int(round(seconds * self.tempo_bpm / 60.0 * self.ticks_per_beat))
+
+    def add_track(self, name, notes, channel=0, program=None):
+        """notes — (начало в секундах, длительность в секундах, нота, velocity)"""
+        events = []
+        if program is not None:
+            events.append((0, 0, bytes([0xC0 | channel, program])))
+
+        timed = []
+        last = {}
+        for start, duration, pitch, vel in sorted(notes):
+            on = self.ticks(start)
+            note = [on, max(on + 1, self.ticks(start + duration)), pitch, vel]
+            prev = last.get(pitch)
+            if prev is not None and prev[0] == on:
+                # Та же нота в тот же тик — одно событие
+                prev[1], prev[3] = max(prev[1], note[1]), max(prev[3], vel)
+                continue
+            if prev is not None and prev[1] > on:
+                # Повтор ноты обрывает предыдущую, иначе note-off закроет новую
+                prev[1] = on
+            timed.append(note)
+            last[pitch] = note
+
+        for on, off, pitch, vel in timed:
+            events.append((on, 1, bytes([0x90 | channel, pitch, vel])))
+            events.append((off, 0, bytes([0x80 | channel, pitch, 0])))
+
+        # Note-off раньше note-on в тот же тик
+        events.sort(key=lambda event: (event[0], event[1]))
+        self.tracks.append(self.track_chunk(events, name))
+
+    def meta(self, kind, data):
+        return bytes([0xFF, kind]) + var_len(len(data)) + data
+
+    def track_chunk(self, events, name=None):
+        body = bytearray()
+        if name:
+            body += b'\x00' + self.meta(0x03, name.encode('utf-8'))
+        tick = 0
+        for at, _, message in events:
+            body += var_len(at - tick) + message
+            tick = at
+        body += b'\x00' + self.meta(0x2F, b'')
+        return b'MTrk' + struct.pack('>I', len(body)) + bytes(body)
+
+    def to_bytes(self):
+        tempo = int(round(60_000_000 / self.tempo_bpm))
+        conductor = [
+            (0, 0, self.meta(0x51, tempo.to_bytes(3, 'big'))),
+            (0, 0, self.meta(0x58, bytes([self.beats_per_bar, 2, 24, 8])))
+        ]
+        header = b'MThd' + struct.pack('>IHHH', 6, 1, len(self.tracks) + 1, self.ticks_per_beat)
+        return header + self.track_chunk(conductor) + b''.join(self.tracks)
@@ -1,12 +1,760 @@
 import numpy as np
-from scipy.io.wavfile import write
 import os
 import random
 import math
+import hashlib
+import json
+import struct
+import threading
+import time
+import contextvars
+import multiprocessing
+from collections import namedtuple, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from operator import attrgetter
+from scipy import fft as sp_fft
+from scipy.signal import lfilter, firwin, resample_poly
+from scipy.ndimage import minimum_filter1d
 
-class ProMusicGenerator:
+from flac_encoder import FlacEncoder
+from midi_export import MidiFile, DRUM_NOTES, DRUM_CHANNEL, midi_pitch, velocity
+from dsp_graph import Graph, Block, Bus, Oscillator, Envelope, Gain, Pan, Mixer, Reverb
+
+# Событие ноты: start — в сэмплах, duration — в секундах
+NoteEvent = namedtuple('NoteEvent', ['start', 'freq', 'duration', 'instrument', 'volume'])
+
+# Меняется при любом изменении, влияющем на звук: старые кэши становятся недействительными
+ENGINE_VERSION = '8'
+
+BEATS_PER_BAR = 4
+
+# Импульсные характеристики зала по жанрам: время затухания RT60, предзадержка, яркость
+REVERB_ROOMS = {
+    'классика': (2.2, 0.025, 0.35),
+    'поп': (1.0, 0.012, 0.5),
+    'рок': (0.8, 0.008, 0.55),
+    'джаз': (1.2, 0.015, 0.4),
+    'ambient': (3.0, 0.03, 0.3)
+}
+
+# Программы General MIDI для экспорта: мелодия по инструменту, бас — Synth Bass 1
+MIDI_PROGRAMS = {'электронные': 81, 'акустические': 24, 'оркестровые': 48}
+MIDI_DEFAULT_PROGRAM = 79
+MIDI_BASS_PROGRAM = 38
+
+# Превью: моно, пониженная частота и обрезанный спектр — ради скорости
+PREVIEW_SAMPLE_RATE = 22050
+PREVIEW_MAX_HARMONIC = 8
+PREVIEW_SECONDS = (10, 20)
+
+# Формат файла на выдаче: расширение и MIME-тип
+AUDIO_FORMATS = {'wav': 'audio/wav', 'flac': 'audio/flac'}
+
+# Допустимая целевая громкость мастера, дБ FS (RMS)
+LOUDNESS_RANGE = (-30.0, -6.0)
+
+# Частоты выдачи; черновики рендерятся на половинной частоте
+SAMPLE_RATES = (22050, 44100, 48000)
+DRAFT_SAMPLE_RATE = 22050
+
+# Раскладка выхода: число каналов файла
+CHANNEL_LAYOUTS = {'mono': 1, 'stereo': 2}
+
+# Усиления дорожек и их панорама (начало, конец трека) по закону постоянной мощности
+STEM_GAINS = {'drums': 0.35, 'bass': 0.4, 'melody': 0.5}
+STEM_PAN = {'drums': (0.0, 0.0), 'bass': (0.0, 0.0), 'melody': (0.3, -0.3)}
+
+# Модель стоимости рендера (замеры benchmark.py на одном ядре): CPU-секунды на
+# минуту аудио для синтеза со сведением и для кодирования FLAC; память — база
+# процесса (кэш нот, таблицы, буферы блоков) и число копий сегмента
+COST_CPU_PER_MIN = 0.8
+COST_FLAC_CPU_PER_MIN = 3.2
+COST_BASE_MB = 24
+COST_SEGMENT_COPIES = 2.5
+COST_RESAMPLE_CPU_PER_MIN = 0.2
+
+
+# Таймер стадий текущего рендера; в потоки дорожек передаётся через copy_context
+_stage_timer = contextvars.ContextVar('stage_timer', default=None)
+
+
+class StageTimer:
+    """Накопленное время (perf_counter) по стадиям рендера, потокобезопасно.
+    
+    Стадии: events, drums/bass/melody (в них входит synth), master (в нём reverb),
+    limiter, pcm, encode, write; обработчики запросов добавляют свои.
+    Время дорожек из параллельных потоков складывается, поэтому сумма
+    может быть больше настенного времени. Сегменты в других процессах не учитываются.
+    """
+    
     def __init__(self):
-        self.sample_rate = 44100
+        self.totals = {}
+        self.lock = threading.Lock()
+    
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+    
+    @contextmanager
+    def activate(self):
+        token = _stage_timer.set(self)
+        try:
+            yield self
+        finally:
+            _stage_timer.reset(token)
+    
+    def snapshot(self):
+        with self.lock:
+            return {name: round(seconds, 4) for name, seconds in self.totals.items()}
+
+
+@contextmanager
+def stage(name):
+    """Замер стадии, если для текущего рендера включён StageTimer"""
+    timer = _stage_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+def bar_rng(seed, stem, bar):
+    """ГСЧ такта: случайность зависит только от (сид, дорожка, такт)"""
+    return random.Random(f'{seed}:{stem}:{bar}')
+
+
+def bar_span(window, beat_samples, beats):
+    """Такты, ноты которых могут начинаться в окне [start, end) (в сэмплах)"""
+    if window is None:
+        return 0, math.ceil(beats / BEATS_PER_BAR)
+    start, end = window
+    first = max(0, int(start / beat_samples) - 1) // BEATS_PER_BAR
+    last = min(beats, int(end / beat_samples) + 2)
+    return first, math.ceil(last / BEATS_PER_BAR)
+
+
+def in_window(events, window):
+    if window is None:
+        return events
+    return [ev for ev in events if window[0] <= ev.start < window[1]]
+
+
+def wav_header(sample_rate, channels, n_frames, sample_width=2):
+    """RIFF/WAVE заголовок PCM для заранее известной длины"""
+    data_size = n_frames * channels * sample_width
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate,
+        sample_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+        b'data', data_size
+    )
+
+
+# Паттерн ударных: доли внутри цикла, длина цикла в долях, громкость
+DRUM_PATTERN = {
+    'kick': ([0], 1, 0.4),
+    'snare': ([0.5], 2, 0.3),
+    'hat': ([0, 0.5], 1, 0.08)
+}
+
+
+class WavEncoder:
+    """PCM без сжатия с тем же интерфейсом, что у FlacEncoder"""
+    
+    def __init__(self, sample_rate, channels, total_samples):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.total_samples = total_samples
+    
+    def head(self):
+        return wav_header(self.sample_rate, self.channels, self.total_samples)
+    
+    def encode(self, pcm):
+        return pcm.tobytes()
+    
+    def flush(self):
+        return b''
+
+
+class WavMemmapSink:
+    """WAV-файл, заранее выделенный на диске: блоки пишутся прямо в отображённые данные.
+    
+    Перевод в int16 идёт сразу в страницы файла — без промежуточного буфера и
+    write(); сброс на диск делает page cache.
+    """
+    
+    def __init__(self, filepath, sample_rate, channels, total_samples):
+        self.filepath = filepath
+        self.total_samples = total_samples
+        self.pos = 0
+        header = wav_header(sample_rate, channels, total_samples)
+        size = len(header) + total_samples * channels * 2
+        with open(filepath, 'wb') as f:
+            f.write(header)
+            if hasattr(os, 'posix_fallocate'):
+                # Место резервируется сразу: нехватка диска — ошибка до рендера, а не SIGBUS в середине
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+        self.data = np.memmap(filepath, dtype='<i2', mode='r+', offset=len(header), shape=(total_samples, channels))
+    
+    def write(self, block):
+        """Блок float32 в [-1, 1] (портится: масштабируется на месте)"""
+        end = self.pos + len(block)
+        if end > self.total_samples:
+            raise ValueError(f'Блок выходит за конец файла: {end} > {self.total_samples}')
+        block *= 32767
+        np.copyto(self.data[self.pos:end], block, casting='unsafe')
+        self.pos = end
+    
+    def close(self):
+        if self.data is not None:
+            self.data.flush()
+            # Последняя ссылка на отображение: файл закрывается до переименования
+            self.data = None
+
+
+class DrumKit:
+    """Банк однократных сэмплов ударных для одной частоты дискретизации"""
+    
+    def __init__(self, sample_rate, chunk_samples=1 << 20):
+        self.sample_rate = sample_rate
+        self.chunk_samples = chunk_samples
+        rng = np.random.default_rng(0)
+        self.samples = {
+            'kick': self.tone(0.2, 50, 100, 30, 8),
+            'snare': self.tone(0.15, 200, 0, 0, 10) * 0.6 + self.noise(rng, 0.15, 20) * 0.4,
+            'hat': self.noise(rng, 0.05, 60, highpass=True),
+            'open_hat': self.noise(rng, 0.3, 10, highpass=True),
+            'tom_low': self.tone(0.3, 80, 40, 20, 7),
+            'tom_mid': self.tone(0.3, 110, 50, 20, 7),
+            'tom_high': self.tone(0.3, 160, 60, 20, 7)
+        }
+        for piece, sample in self.samples.items():
+            sample /= np.max(np.abs(sample))
+            self.samples[piece] = sample.astype(np.float32)
+    
+    def tone(self, duration, freq, sweep, sweep_rate, decay):
+        """Синус с падающей высотой и экспоненциальным затуханием"""
+        t = np.arange(int(duration * self.sample_rate)) / self.sample_rate
+        freqs = freq + sweep * np.exp(-t * sweep_rate)
+        phase = 2 * np.pi * np.cumsum(freqs) / self.sample_rate
+        return np.sin(phase) * np.exp(-t * decay)
+    
+    def noise(self, rng, duration, decay, highpass=False):
+        """Шумовой удар; highpass — для тарелок"""
+        n_samples = int(duration * self.sample_rate)
+        burst = rng.standard_normal(n_samples + 1)
+        burst = np.diff(burst) if highpass else burst[1:]
+        return burst * np.exp(-np.arange(n_samples) / self.sample_rate * decay)
+    
+    def duration(self, piece):
+        return len(self.samples[piece]) / self.sample_rate
+    
+    def place(self, out, piece, starts, volume=1.0):
+        """Scatter-add сэмпла во все позиции за один векторный проход"""
+        sample = self.samples[piece] * np.float32(volume)
+        n_samples = len(sample)
+        starts = np.sort(np.asarray(starts, dtype=np.intp))
+        starts = starts[(starts >= 0) & (starts + n_samples < len(out))]
+        if not len(starts):
+            return out
+        
+        # Удары разводятся по дорожкам без наложений — индексы внутри дорожки уникальны
+        gaps = np.diff(starts)
+        min_gap = gaps.min() if len(gaps) else n_samples
+        lanes = len(starts) if min_gap == 0 else min(len(starts), -(-n_samples // min_gap))
+        rows = max(1, self.chunk_samples // n_samples)
+        offsets = np.arange(n_samples)
+        
+        for lane in range(lanes):
+            lane_starts = starts[lane::lanes]
+            for b in range(0, len(lane_starts), rows):
+                out[lane_starts[b:b + rows, None] + offsets] += sample
+        
+        return out
+
+
+class WavetableBank:
+    """Банк волновых таблиц с ограничением спектра по октавам"""
+    
+    def __init__(self, sample_rate, table_size=2048, base_freq=20.0, octaves=11, max_harmonic=None):
+        self.sample_rate = sample_rate
+        # Верхняя граница номера обертона (для быстрого превью); None — до Найквиста
+        self.max_harmonic = max_harmonic
+        self.table_size = table_size
+        self.base_freq = base_freq
+        self.octaves = octaves
+        self.tables = {}
+    
+    def series(self, waveform, max_harmonic):
+        """Ряд Фурье формы волны: номера гармоник и комплексные амплитуды"""
+        m = np.arange(1, max_harmonic + 1)
+        if waveform == 'sawtooth':
+            return m, -1j * (2 / np.pi) * (-1.0) ** (m + 1) / m
+        if waveform == 'square':
+            m = m[m % 2 == 1]
+            return m, -1j * (4 / np.pi) / m
+        if waveform == 'triangle':
+            m = m[m % 2 == 1]
+            return m, -(8 / np.pi ** 2) / m ** 2 + 0j
+        m = m[:1]
+        return m, -1j * np.ones(len(m))
+    
+    def build(self, waveform, harmonics=(1,)):
+        """Таблицы (октава × фаза): сумма обертонов формы волны"""
+        key = (waveform, tuple(harmonics))
+        if key in self.tables:
+            return self.tables[key]
+        
+        size = self.table_size
+        nyquist = self.sample_rate / 2
+        table = np.zeros((self.octaves, size + 1), dtype=np.float32)
+        
+        for octave in range(self.octaves):
+            top_freq = self.base_freq * 2 ** (octave + 1)
+            limit = min(int(nyquist // top_freq), size // 2 - 1)
+            if self.max_harmonic:
+                limit = min(limit, self.max_harmonic)
+            spectrum = np.zeros(size // 2 + 1, dtype=np.complex128)
+            for i, harmonic_vol in enumerate(harmonics):
+                partial = i + 1
+                m, coeffs = self.series(waveform, limit // partial)
+                spectrum[m * partial] += harmonic_vol * coeffs
+            table[octave, :size] = np.fft.irfft(spectrum * (size / 2), size)
+            table[octave, size] = table[octave, 0]
+        
+        self.tables[key] = table
+        return table
+    
+    def lookup(self, table, phase, freq):
+        """Чтение таблицы по фазе (в периодах) с линейной интерполяцией"""
+        ratio = np.maximum(np.asarray(freq, dtype=np.float64), self.base_freq) / self.base_freq
+        octave = np.minimum(np.log2(ratio).astype(np.intp), self.octaves - 1)
+        
+        size = self.table_size
+        pos = np.fmod(phase * size, size)
+        idx = pos.astype(np.intp)
+        frac = (pos - idx).astype(np.float32)
+        
+        # Плоский индекс в (октава × фаза), сбор через take
+        idx += octave * (size + 1)
+        lo = table.take(idx)
+        hi = table.take(idx + 1)
+        hi -= lo
+        hi *= frac
+        hi += lo
+        return hi
+    
+    def oscillate(self, table, freqs, n_samples):
+        """Фазовый аккумулятор: строка сэмплов на каждую частоту"""
+        freqs = np.asarray(freqs, dtype=np.float64).reshape(-1, 1)
+        phase = np.arange(n_samples) * (freqs / self.sample_rate)
+        return self.lookup(table, phase, freqs)
+
+
+class ReverbBank:
+    """Спектры разделов импульсных характеристик по жанрам (считаются один раз)"""
+    
+    def __init__(self, sample_rate, partition=4096, fft_workers=1):
+        self.sample_rate = sample_rate
+        self.partition = partition
+        self.fft_workers = fft_workers
+        self.spectra = {}
+    
+    @staticmethod
+    def room(genre):
+        """Зал для жанра; неизвестные жанры звучат в зале 'поп'"""
+        key = genre.lower()
+        return key if key in REVERB_ROOMS else 'поп'
+    
+    def impulse_response(self, room):
+        """Синтетический зал: ранние отражения и затухающий шум с завалом верхов"""
+        rt60, predelay, brightness = REVERB_ROOMS[room]
+        sr = self.sample_rate
+        # Шум зависит только от зала: у одного зала одна и та же ИХ
+        rng = np.random.default_rng(list(REVERB_ROOMS).index(room))
+        
+        n = int((predelay + rt60) * sr)
+        t = np.arange(n) / sr
+        tail = rng.standard_normal(n) * np.exp(-6.9 * t / rt60)
+        tail[:int(predelay * sr)] = 0
+        # Однополюсный ФНЧ: хвост темнее ранних отражений
+        tail = lfilter([brightness], [1, brightness - 1], tail)
+        
+        for delay, gain in ((0.5, 0.6), (0.8, -0.45), (1.3, 0.35)):
+            tail[int(predelay * delay * sr)] += gain * np.sqrt(sr / 1000)
+        tail /= np.sqrt(np.sum(tail ** 2))
+        return tail
+    
+    def get(self, genre):
+        """Разделы ИХ длиной partition в частотной области: (K, partition + 1)"""
+        key = self.room(genre)
+        if key not in self.spectra:
+            p = self.partition
+            ir = self.impulse_response(key)
+            parts = np.zeros((-(-len(ir) // p), 2 * p), dtype=np.float32)
+            parts[:, :p].flat[:len(ir)] = ir
+            self.spectra[key] = sp_fft.rfft(parts, axis=1, workers=self.fft_workers)
+        return self.spectra[key]
+    
+    def reverb(self, genre):
+        return ConvolutionReverb(self.get(genre), self.partition, self.fft_workers)
+
+
+class ConvolutionReverb:
+    """Свёртка с ИХ по равным разделам (uniformly partitioned overlap-add).
+    
+    Вход режется на куски длиной partition; спектры последних K кусков лежат
+    в кольцевой линии задержки и умножаются на спектры K разделов ИХ.
+    Задержки нет, но все блоки, кроме последнего, должны быть кратны partition.
+    """
+    
+    def __init__(self, spectra, partition, fft_workers=1):
+        self.spectra = spectra
+        self.partition = partition
+        self.fft_workers = fft_workers
+        self.history = np.zeros_like(spectra)
+        self.head = 0
+        self.overlap = np.zeros(partition, dtype=np.float32)
+        self.length = len(spectra) * partition
+        self.padded = np.zeros((0, 2 * partition), dtype=np.float32)
+    
+    def process(self, x, out):
+        """Мокрый сигнал блока x в out (той же длины)"""
+        with stage('reverb'):
+            self.convolve(x, out)
+    
+    def convolve(self, x, out):
+        p, k = self.partition, len(self.spectra)
+        chunks = -(-len(x) // p)
+        if len(self.padded) < chunks:
+            self.padded = np.zeros((chunks, 2 * p), dtype=np.float32)
+        padded = self.padded[:chunks]
+        padded[:, :p] = 0
+        padded[:, :p].flat[:len(x)] = x
+        inputs = sp_fft.rfft(padded, axis=1, workers=self.fft_workers)
+        
+        acc = np.empty_like(inputs)
+        for c in range(chunks):
+            self.head = (self.head - 1) % k
+            self.history[self.head] = inputs[c]
+            # history[head + j] — кусок j шагов назад, он встречает раздел j
+            order = np.r_[self.head:k, 0:self.head]
+            np.einsum('kf,kf->f', self.history[order], self.spectra, out=acc[c])
+        
+        wet = sp_fft.irfft(acc, n=2 * p, axis=1, workers=self.fft_workers)
+        wet[0, :p] += self.overlap
+        wet[1:, :p] += wet[:-1, p:]
+        self.overlap[:] = wet[-1, p:]
+        out[:] = wet[:, :p].flat[:len(out)]
+
+
+class Resampler:
+    """Потоковый resample_poly: блоки дают тот же результат, что весь сигнал целиком.
+    
+    Каждый кусок обрабатывается с контекстом по обе стороны не короче
+    фильтра; границы кусков кратны down, поэтому фазы полифазного фильтра
+    совпадают с расчётом по всему сигналу. Задержка — context входных сэмплов.
+    """
+    
+    def __init__(self, rate_in, rate_out, channels=2):
+        g = math.gcd(rate_in, rate_out)
+        self.up, self.down = rate_out // g, rate_in // g
+        # Тот же ФНЧ, что resample_poly строит по умолчанию; считается один раз
+        max_rate = max(self.up, self.down)
+        half_len = 10 * max_rate
+        self.window = firwin(2 * half_len + 1, 1.0 / max_rate, window=('kaiser', 5.0)).astype(np.float32)
+        self.context = math.ceil((half_len + self.down) / self.up / self.down + 1) * self.down
+        # Нули перед началом — как дополнение нулями в resample_poly
+        self.buffer = np.zeros((self.context, channels), dtype=np.float32)
+        self.consumed = 0
+        self.emitted = 0
+    
+    def resample(self, chunk, n_out):
+        y = resample_poly(chunk, self.up, self.down, axis=0, window=self.window)
+        start = self.context * self.up // self.down
+        out = y[start:start + n_out]
+        # Пульсации фильтра могут чуть превысить потолок лимитера
+        np.clip(out, -1.0, 1.0, out=out)
+        self.emitted += len(out)
+        return out
+    
+    def process(self, x):
+        self.buffer = np.concatenate((self.buffer, x))
+        usable = len(self.buffer) - 2 * self.context
+        usable -= usable % self.down
+        if usable <= 0:
+            return np.zeros((0, self.buffer.shape[1]), dtype=np.float32)
+        chunk = self.buffer[:usable + 2 * self.context]
+        self.buffer = self.buffer[usable:]
+        self.consumed += usable
+        return self.resample(chunk, usable * self.up // self.down)
+    
+    def flush(self):
+        """Остаток с нулями после конца; длина выхода — ceil(n * up / down), как у resample_poly"""
+        remaining = len(self.buffer) - self.context
+        total = self.consumed + remaining
+        n_out = -(-total * self.up // self.down) - self.emitted
+        chunk = np.concatenate((self.buffer, np.zeros((self.context, self.buffer.shape[1]), dtype=np.float32)))
+        self.buffer = self.buffer[:0]
+        return self.resample(chunk, n_out)
+
+
+class Limiter:
+    """Потоковый лимитер с заглядыванием вперёд: пик никогда не превышает ceiling.
+    
+    Требуемое усиление ceiling / |x| сворачивается скользящим минимумом на
+    lookahead сэмплов вперёд и сглаживается средним той же длины — каждое
+    значение среднего не больше требуемого. Восстановление — экспоненциальное
+    (убывающий максимум глубины подавления, считается через накопленный максимум).
+    Выход задержан на lookahead - 1 сэмплов: первые вызовы возвращают меньше
+    (пока не отброшена вся задержка), flush() — остаток.
+    """
+    
+    def __init__(self, sample_rate, channels=2, ceiling=0.99, lookahead=0.005, release=0.1):
+        self.ceiling = ceiling
+        # Нечётная длина окна — центрированный минимум сдвигается ровно на половину
+        self.window = int(lookahead * sample_rate) // 2 * 2 + 1
+        self.delay = self.window - 1
+        self.release = math.exp(-1.0 / (release * sample_rate))
+        self.audio = np.zeros((self.delay, channels), dtype=np.float32)
+        self.required = np.ones(self.delay)
+        self.history = np.ones(self.window - 1)
+        self.depth = 0.0
+        # Сколько сэмплов задержки ещё отбросить с начала выхода
+        self.priming = self.delay
+    
+    def process(self, x):
+        """Следующий кусок выхода (новый массив, длина как у x, кроме первых вызовов)"""
+        n = len(x)
+        audio = np.concatenate((self.audio, x))
+        # Максимум по каналам поканально: reduce по короткой оси у NumPy медленный
+        peak = np.abs(x[:, 0])
+        for ch in range(1, x.shape[1]):
+            np.maximum(peak, np.abs(x[:, ch]), out=peak)
+        required = np.concatenate((self.required, self.ceiling / np.maximum(peak, self.ceiling)))
+        
+        # Минимум по окну [k, k + window) для каждого выходного сэмпла k
+        lowest = minimum_filter1d(required, self.window)[self.delay // 2:self.delay // 2 + n]
+        smooth = np.cumsum(np.concatenate(([0.0], self.history, lowest)))
+        smooth = (smooth[self.window:] - smooth[:-self.window]) / self.window
+        
+        # Глубина подавления d[i] = max(1 - g[i], d[i-1]·r): накопленный максимум в логарифмах
+        decay = math.log(self.release)
+        steps = np.arange(1, n + 1) * decay
+        with np.errstate(divide='ignore'):
+            depth = np.log(np.maximum(1.0 - smooth, 0.0)) - steps
+            start = math.log(self.depth) if self.depth > 0 else -np.inf
+        depth = np.exp(np.maximum(np.maximum.accumulate(depth), start) + steps)
+        
+        out = audio[:n] * (1.0 - depth).astype(np.float32)[:, None]
+        self.audio = audio[n:]
+        self.required = required[n:]
+        self.history = np.concatenate((self.history, lowest))[-(self.window - 1):]
+        self.depth = float(depth[-1]) if n else self.depth
+        
+        if self.priming:
+            drop = min(self.priming, len(out))
+            self.priming -= drop
+            return out[drop:]
+        return out
+    
+    def flush(self):
+        return self.process(np.zeros((self.delay, self.audio.shape[1]), dtype=np.float32))
+
+
+class NoteCache:
+    """LRU-кэш отрендеренных нот с ограничением по памяти"""
+    
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            buffer = self.items.get(key)
+            if buffer is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return buffer
+    
+    def put(self, key, buffer):
+        if buffer.nbytes > self.max_bytes:
+            return
+        buffer.setflags(write=False)
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.items[key] = buffer
+            self.nbytes += buffer.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+    
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+    
+    def stats(self):
+        """Счётчики кэша для мониторинга"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.items),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+class EnvelopeBank:
+    """ADSR по точкам излома: одна интерполяция на огибающую, готовые — в LRU-кэше.
+    
+    Ключ — (длина, attack, decay, sustain, release, частота дискретизации);
+    повторная длина ноты — частый случай — берётся из кэша. Огибающие только
+    для чтения.
+    """
+    
+    def __init__(self, sample_rate, max_bytes=16 * 1024 * 1024):
+        self.sample_rate = sample_rate
+        self.cache = NoteCache(max_bytes)
+    
+    def breakpoints(self, n, attack, decay, sustain, release):
+        """Точки излома в сэмплах.
+        
+        Релиз занимает не больше половины ноты и начинается с уровня, которого
+        огибающая достигла к этому моменту: у короткой ноты атака и спад
+        обрываются, а не накладываются на релиз.
+        """
+        sr = self.sample_rate
+        a, d = attack * sr, decay * sr
+        r = min(release * sr, n / 2)
+        gate = n - r
+        xp, fp = [0.0, a, a + d], [0.0 if a > 0 else 1.0, 1.0, sustain]
+        level = float(np.interp(gate, xp, fp))
+        points = [(x, y) for x, y in zip(xp, fp) if x < gate] + [(gate, level)]
+        if r > 0:
+            points.append((float(n), 0.0))
+        # np.interp нужны возрастающие x: из совпавших точек (нулевая атака или спад) остаётся последняя
+        points = [p for p, following in zip(points, points[1:] + [None]) if following is None or p[0] < following[0]]
+        x, y = zip(*points)
+        return np.array(x), np.array(y)
+    
+    def get(self, n, attack=0.01, decay=0.1, sustain=0.7, release=0.2):
+        key = (n, attack, decay, sustain, release, self.sample_rate)
+        env = self.cache.get(key)
+        if env is None:
+            xp, fp = self.breakpoints(n, attack, decay, sustain, release)
+            env = np.interp(np.arange(n, dtype=np.float32), xp, fp).astype(np.float32)
+            self.cache.put(key, env)
+        return env
+    
+    def stats(self):
+        return self.cache.stats()
+
+
+class RenderCache:
+    """Кэш готовых треков на диске: имя файла содержит хеш параметров"""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+    
+    def lookup(self, filename):
+        """True, если трек уже отрендерен и лежит на диске"""
+        found = os.path.exists(self.path(filename))
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+class StemStream:
+    """Поблочный рендер дорожки: хвосты нот переносятся в следующий блок"""
+    
+    def __init__(self, generator, events, total_samples, block_size, gain=1.0, start=0, name='stem'):
+        self.generator = generator
+        self.name = name
+        self.gain = np.float32(gain)
+        # Ноты, не помещающиеся до конца трека, отбрасываются (как в полном рендере)
+        self.events = sorted(
+            (ev for ev in events if ev.start + generator.note_samples(ev) < total_samples),
+            key=attrgetter('start')
+        )
+        self.starts = np.array([ev.start for ev in self.events], dtype=np.int64)
+        self.tail = max((generator.note_samples(ev) for ev in self.events), default=0)
+        self.acc = np.zeros(block_size + self.tail, dtype=np.float32)
+        self.pos = start
+    
+    def read_into(self, out):
+        """Прибавляет следующие len(out) сэмплов дорожки к out (на месте)"""
+        with stage(self.name):
+            n_samples = len(out)
+            lo, hi = np.searchsorted(self.starts, [self.pos, self.pos + n_samples])
+            self.generator.mix_events(self.acc, self.events[lo:hi], self.pos)
+            
+            head = self.acc[:n_samples]
+            head *= self.gain
+            out += head
+            self.acc[:-n_samples] = self.acc[n_samples:]
+            self.acc[-n_samples:] = 0
+            self.pos += n_samples
+        return out
+
+
+_segment_generators = {}
+
+
+def _render_segment(kwargs, sample_rate):
+    """Рендер сегмента трека в процессе пула (до мастеринга); генератор на каждую частоту"""
+    if sample_rate not in _segment_generators:
+        _segment_generators[sample_rate] = ProMusicGenerator(stem_workers=0, segment_workers=1,
+                                                             sample_rate=sample_rate)
+    return _segment_generators[sample_rate].render_segment(**kwargs)
+
+
+class ProMusicGenerator:
+    def __init__(self, stem_workers=None, segment_workers=None, sample_rate=None, max_harmonic=None):
+        # Внутренняя частота рендера; частота выдачи задаётся при рендере (sample_rate)
+        if sample_rate is None:
+            sample_rate = int(os.environ.get('RENDER_SAMPLE_RATE', 44100))
+        self.sample_rate = sample_rate
         self.scales = {
             'классика': ['C', 'D', 'E', 'F', 'G', 'A', 'B'],
             'поп': ['C', 'D', 'E', 'F', 'G', 'A', 'B'], 
@@ -19,23 +767,38 @@ class ProMusicGenerator:
             'E': 329.63, 'F': 349.23, 'F#': 369.99, 'G': 392.00, 'G#': 415.30,
             'A': 440.00, 'A#': 466.16, 'Bb': 466.16, 'B': 493.88
         }
+        # Максимум сэмплов в одном векторном проходе (ограничивает память)
+        self.batch_samples = 1 << 21
+        # Размер блока потокового рендера и усиление мастера
+        self.block_size = 32768
+        self.master_gain = 3.2
+        self.wavetables = WavetableBank(self.sample_rate, max_harmonic=max_harmonic)
+        # Скомпилированные графы инструментов
+        self.instrument_plans = {}
+        self.drum_kit = DrumKit(self.sample_rate)
+        # Потоки FFT для свёрточного ревербератора
+        self.reverbs = ReverbBank(self.sample_rate, fft_workers=int(os.environ.get('FFT_WORKERS', 1)))
+        # Общий для всех запросов воркера
+        self.note_cache = NoteCache()
+        self.envelopes = EnvelopeBank(self.sample_rate)
+        # Потоки для параллельного рендера дорожек (0 — последовательно)
+        if stem_workers is None:
+            stem_workers = int(os.environ.get('STEM_WORKERS', min(3, (os.cpu_count() or 1) - 1)))
+        self.stem_workers = stem_workers
+        self.stem_pool = None
+        # Трек режется на сегменты по segment_bars тактов; разбиение фиксировано,
+        # поэтому число процессов (segment_workers) не влияет на результат
+        self.segment_bars = 16
+        if segment_workers is None:
+            segment_workers = int(os.environ.get('RENDER_SEGMENT_WORKERS', 1))
+        self.segment_workers = segment_workers
+        self.segment_pool = None
+        self.preview_generator = None
+        self.rate_generators = {}
     
     def adsr_envelope(self, t, attack=0.01, decay=0.1, sustain=0.7, release=0.2):
-        """Реалистичная ADSR огибающая"""
-        env = np.ones_like(t)
-        
-        attack_samples = int(attack * self.sample_rate)
-        decay_samples = int(decay * self.sample_rate)
-        release_samples = int(release * self.sample_rate)
-        
-        if attack_samples > 0:
-            env[:attack_samples] = np.linspace(0, 1, attack_samples)
-        if decay_samples > 0:
-            env[attack_samples:attack_samples+decay_samples] = np.linspace(1, sustain, decay_samples)
-        if release_samples > 0 and len(env) > release_samples:
-            env[-release_samples:] = np.linspace(sustain, 0, release_samples)
-            
-        return env
+        """Реалистичная ADSR огибающая (копия из банка огибающих, длиной как t)"""
+        return self.envelopes.get(len(t), attack, decay, sustain, release).astype(t.dtype)
     
     def get_instrument(self, instr_type):
         """Характеристики инструментов"""
@@ -47,135 +810,674 @@ class ProMusicGenerator:
     
     def generate_note(self, freq, duration, instrument, volume=0.4):
         """Многослойная нота с гармониками"""
-        t = np.linspace(0, duration, int(self.sample_rate * duration), False)
-        note = np.zeros_like(t)
+        n_samples = int(self.sample_rate * duration)
+        return self.cached_notes([freq], n_samples, instrument, volume)[0].copy()
+    
+    def instrument_plan(self, instrument):
+        """Граф инструмента: осциллятор → огибающая; компилируется один раз"""
+        key = instrument.lower()
+        if key not in self.instrument_plans:
+            instr = self.get_instrument(instrument)
+            curve = lambda n: self.envelopes.get(n, instr['attack'], instr['decay'])
+            
+            graph = Graph()
+            # Все гармоники инструмента сведены в одну таблицу
+            graph.add('osc', Oscillator(self.wavetables, instr['waveform'], instr['harmonics']))
+            graph.add('out', Envelope(curve), 'osc')
+            self.instrument_plans[key] = graph.compile('out')
+        return self.instrument_plans[key]
+    
+    def render_notes(self, freqs, n_samples, instrument, volume=0.4):
+        """Пачка нот одной длины и тембра: строка на каждую частоту"""
+        block = Block(0, n_samples, freqs=freqs, level=volume * 0.3)
+        return self.instrument_plan(instrument).run(block)
+    
+    def master_plan(self, genre, channels=2):
+        """Граф сведения: дорожки → панорама каждой → стерео-микшер; посыл на реверберацию — моно.
         
-        instr = self.get_instrument(instrument)
-        env = self.adsr_envelope(t, instr['attack'], instr['decay'])
+        Дорожки с одинаковой панорамой сводятся в моно и панорамируются вместе,
+        реверберация звучит по центру. Моно-выход — без панорамы, с уровнем
+        центра (как среднее каналов стерео). У графа есть состояние (хвост
+        реверберации), поэтому он свой на каждый рендер.
+        """
+        graph = Graph()
+        for stem in STEM_GAINS:
+            graph.add(stem, Bus())
+        graph.add('mix', Mixer(list(STEM_GAINS.values())), *STEM_GAINS)
+        graph.add('reverb', Reverb(self.reverbs.reverb(genre)), 'mix')
+        graph.add('wet', Gain(0.2, end=0.04), 'reverb')
         
-
-        for i, harmonic_vol in enumerate(instr['harmonics'][:3]):
-            harmonic_freq = freq * (i + 1)
-            wave = self.get_waveform(t, harmonic_freq, instr['waveform'])
-            note += wave * harmonic_vol * env
+        center = Pan.gains(0.0)[0]
+        if channels == 1:
+            graph.add('out', Mixer([center, center]), 'mix', 'wet')
+            return graph.compile('out')
         
-        return (note * volume * 0.3).astype(np.float32)
+        groups = {}
+        for stem, position in STEM_PAN.items():
+            groups.setdefault(position, []).append(stem)
+        groups.setdefault((0.0, 0.0), []).append('wet')
+        pans = []
+        for i, (position, sources) in enumerate(groups.items()):
+            weights = [STEM_GAINS.get(source) for source in sources]
+            graph.add(f'group{i}', Mixer(weights), *sources)
+            pans.append(graph.add(f'pan{i}', Pan(position), f'group{i}'))
+        graph.add('out', Mixer(), *pans)
+        return graph.compile('out')
     
-    def get_waveform(self, t, freq, waveform='sine'):
-        """Формы волн"""
-        if waveform == 'square':
-            return np.sign(np.sin(2 * np.pi * freq * t))
-        elif waveform == 'sawtooth':
-            return 2 * (freq * t - np.floor(freq * t + 0.5))
-        elif waveform == 'triangle':
-            return 2 * np.abs(2 * (freq * t - np.floor(freq * t + 0.5))) - 1
-        return np.sin(2 * np.pi * freq * t)
+    def cached_notes(self, freqs, n_samples, instrument, volume):
+        """Ноты из LRU-кэша; промахи синтезируются одной пачкой"""
+        notes = [self.note_cache.get((float(f), n_samples, instrument, volume)) for f in freqs]
+        missing = [i for i, note in enumerate(notes) if note is None]
+        
+        rows = max(1, self.batch_samples // max(n_samples, 1))
+        for b in range(0, len(missing), rows):
+            batch = missing[b:b + rows]
+            with stage('synth'):
+                rendered = self.render_notes([freqs[i] for i in batch], n_samples, instrument, volume)
+                rendered = [note.copy() for note in rendered]
+            for i, note in zip(batch, rendered):
+                self.note_cache.put((float(freqs[i]), n_samples, instrument, volume), note)
+                notes[i] = note
+        
+        return notes
     
-    def generate_drums(self, duration, tempo_bpm):
-        """Реалистичные барабаны"""
-        beat_duration = 60.0 / tempo_bpm
-        total_samples = int(self.sample_rate * duration)
-        drums = np.zeros(total_samples)
+    def note_samples(self, ev):
+        """Длина события в сэмплах"""
+        if ev.instrument in self.drum_kit.samples:
+            return len(self.drum_kit.samples[ev.instrument])
+        return int(self.sample_rate * ev.duration)
+    
+    def mix_events(self, out, events, offset=0):
+        """Группировка событий, векторный синтез и overlap-add в out со сдвигом offset"""
+        groups = {}
+        for ev in events:
+            groups.setdefault((self.note_samples(ev), ev.instrument, ev.volume), []).append(ev)
         
-        beats = int(duration / beat_duration)
-        for beat in range(beats):
-
-            if beat % 1 == 0:
-                start = int(beat * beat_duration * self.sample_rate)
-                kick_t = np.linspace(0, 0.2, int(0.2 * self.sample_rate))
-                kick_freq = 60 + beat * 5  # падает
-                kick = np.sin(2 * np.pi * kick_freq * kick_t) * np.exp(-kick_t * 8)
-                if start + len(kick) < total_samples:
-                    drums[start:start+len(kick)] += kick * 0.4
+        for (n_samples, instrument, volume), group in groups.items():
+            starts = [ev.start - offset for ev in group]
+            if instrument in self.drum_kit.samples:
+                self.drum_kit.place(out, instrument, starts, volume)
+                continue
             
-
-            if beat % 2 == 0:
-                snare_start = int((beat + 0.5) * beat_duration * self.sample_rate)
-                snare_t = np.linspace(0, 0.15, int(0.15 * self.sample_rate))
-                snare = np.sin(2 * np.pi * 200 * snare_t) * np.exp(-snare_t * 10) * 0.3
-                if snare_start + len(snare) < total_samples:
-                    drums[snare_start:snare_start+len(snare)] += snare
+            # Одинаковые ноты синтезируются один раз
+            freqs, inverse = np.unique([ev.freq for ev in group], return_inverse=True)
+            notes = self.cached_notes(freqs, n_samples, instrument, volume)
+            
+            for start, i in zip(starts, inverse):
+                out[start:start + n_samples] += notes[i]
         
-        return drums
+        return out
     
-    def generate_bassline(self, scale, duration, tempo_bpm):
-
+    def render_events(self, events, total_samples):
+        """Рендер списка событий целиком в один буфер"""
+        out = np.zeros(total_samples, dtype=np.float32)
+        fitting = [ev for ev in events if ev.start + self.note_samples(ev) < total_samples]
+        return self.mix_events(out, fitting)
+    
+    def drum_events(self, duration, tempo_bpm, pattern=DRUM_PATTERN, window=None):
+        """События ударных по паттерну; звук берётся из банка"""
         beat_duration = 60.0 / tempo_bpm
-        total_samples = int(self.sample_rate * duration)
-        bass = np.zeros(total_samples)
+        beats = int(duration / beat_duration)
+        first_bar, last_bar = bar_span(window, beat_duration * self.sample_rate, beats)
+        events = []
         
+        for piece, (positions, cycle, volume) in pattern.items():
+            piece_duration = self.drum_kit.duration(piece)
+            first_cycle = first_bar * BEATS_PER_BAR // cycle * cycle
+            for bar_start in range(first_cycle, min(beats, last_bar * BEATS_PER_BAR), cycle):
+                for pos in positions:
+                    if bar_start + int(pos) < beats:
+                        start = int((bar_start + pos) * beat_duration * self.sample_rate)
+                        events.append(NoteEvent(start, 0.0, piece_duration, piece, volume))
+        
+        return in_window(events, window)
+    
+    def bassline_events(self, scale, duration, tempo_bpm, seed=0, window=None):
+        """События баса по ритмическому паттерну"""
+        beat_duration = 60.0 / tempo_bpm
         beats = int(duration / beat_duration)
+        first_bar, last_bar = bar_span(window, beat_duration * self.sample_rate, beats)
         bass_pattern = [0, 0, 1, 0, 1, 0, 0, 1]
+        events = []
         
-        for beat in range(beats):
-            if bass_pattern[beat % len(bass_pattern)]:
-                freq = random.choice(scale) * 0.5 
-                start = int(beat * beat_duration * self.sample_rate)
-                note = self.generate_note(freq, beat_duration * 0.7, 'электронные', 0.35)
-                if start + len(note) < total_samples:
-                    bass[start:start+len(note)] += note
+        for bar in range(first_bar, last_bar):
+            rng = bar_rng(seed, 'bass', bar)
+            for beat in range(bar * BEATS_PER_BAR, min(beats, (bar + 1) * BEATS_PER_BAR)):
+                if bass_pattern[beat % len(bass_pattern)]:
+                    freq = rng.choice(scale) * 0.5
+                    start = int(beat * beat_duration * self.sample_rate)
+                    events.append(NoteEvent(start, freq, beat_duration * 0.7, 'электронные', 0.35))
         
-        return bass
+        return in_window(events, window)
     
-    def generate_melody(self, scale, duration, instrument, complexity=0.6):
-
+    def melody_events(self, scale, duration, instrument, complexity=0.6, seed=0, window=None):
+        """События мелодии по аккордовой прогрессии"""
         beat_duration = 0.5
-        total_samples = int(self.sample_rate * duration)
-        melody = np.zeros(total_samples)
-        
         beats = int(duration / beat_duration)
+        first_bar, last_bar = bar_span(window, beat_duration * self.sample_rate, beats)
         chord_progression = [0, 3, 4, 5]
+        events = []
         
-        for beat in range(0, beats, 2):
-
-            root = scale[chord_progression[beat % 4 % len(chord_progression)]]
-            freq = root * random.choice([1, 1.5, 2])
-            
-            start = int(beat * beat_duration * self.sample_rate)
-            note_dur = beat_duration * random.choice([0.8, 1.2, 1.6]) * (1 + complexity)
-            note = self.generate_note(freq, note_dur, instrument, 0.45)
+        for bar in range(first_bar, last_bar):
+            rng = bar_rng(seed, 'melody', bar)
+            for beat in range(bar * BEATS_PER_BAR, min(beats, (bar + 1) * BEATS_PER_BAR), 2):
+                root = scale[chord_progression[beat % 4 % len(chord_progression)]]
+                freq = root * rng.choice([1, 1.5, 2])
+                
+                start = int(beat * beat_duration * self.sample_rate)
+                note_dur = beat_duration * rng.choice([0.8, 1.2, 1.6]) * (1 + complexity)
+                events.append(NoteEvent(start, freq, note_dur, instrument, 0.45))
+        
+        return in_window(events, window)
+    
+    def generate_drums(self, duration, tempo_bpm):
+        """Реалистичные барабаны"""
+        total_samples = int(self.sample_rate * duration)
+        return self.render_events(self.drum_events(duration, tempo_bpm), total_samples)
+    
+    def generate_bassline(self, scale, duration, tempo_bpm, seed=0):
+        total_samples = int(self.sample_rate * duration)
+        return self.render_events(self.bassline_events(scale, duration, tempo_bpm, seed), total_samples)
+    
+    def generate_melody(self, scale, duration, instrument, complexity=0.6, seed=0):
+        total_samples = int(self.sample_rate * duration)
+        return self.render_events(self.melody_events(scale, duration, instrument, complexity, seed), total_samples)
+    
+    def stem_events(self, genre, instrument, length_min, tempo_bpm, seed=0, window=None):
+        """События каждой дорожки трека — и для звука, и для MIDI"""
+        duration = length_min * 60
+        scale = self.get_scale(genre)
+        return {
+            'drums': self.drum_events(duration, tempo_bpm, window=window),
+            'bass': self.bassline_events(scale, duration, tempo_bpm, seed, window),
+            'melody': self.melody_events(scale, duration, instrument, seed=seed, window=window)
+        }
+    
+    def midi_bytes(self, genre, instrument, length_min, tempo_bpm, seed=0):
+        """SMF тип 1: те же ноты, что звучат в треке, по дорожке на стем"""
+        total_samples = self.total_samples(length_min)
+        midi = MidiFile(tempo_bpm, beats_per_bar=BEATS_PER_BAR)
+        for stem, events in self.stem_events(genre, instrument, length_min, tempo_bpm, seed).items():
+            # Как в StemStream: ноты, не помещающиеся до конца трека, не звучат
+            events = [ev for ev in events if ev.start + self.note_samples(ev) < total_samples]
+            if stem == 'drums':
+                notes = [(ev.start / self.sample_rate, ev.duration, DRUM_NOTES[ev.instrument], velocity(ev.volume))
+                         for ev in events]
+                midi.add_track('Drums', notes, channel=DRUM_CHANNEL)
+                continue
+            notes = [(ev.start / self.sample_rate, ev.duration, midi_pitch(ev.freq), velocity(ev.volume))
+                     for ev in events]
+            if stem == 'bass':
+                midi.add_track('Bass', notes, channel=1, program=MIDI_BASS_PROGRAM)
+            else:
+                program = MIDI_PROGRAMS.get(instrument.lower(), MIDI_DEFAULT_PROGRAM)
+                midi.add_track(f'Melody ({instrument})', notes, channel=0, program=program)
+        return midi.to_bytes()
+    
+    def midi_filename(self, **params):
+        """MIDI лежит рядом с треком: то же имя, расширение .mid (общий для WAV и FLAC)"""
+        return os.path.splitext(self.track_filename(**params))[0] + '.mid'
+    
+    def write_midi(self, directory, params):
+        """Запись MIDI трека в directory (если ещё нет); возвращает имя файла"""
+        filename = self.midi_filename(**params)
+        path = os.path.join(directory, filename)
+        if not os.path.exists(path):
+            data = self.midi_bytes(params['genre'], params['instrument'], params['length_min'],
+                                   params['tempo_bpm'], params['seed'])
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return filename
+    
+    def get_scale(self, genre):
+        scale_notes = self.scales.get(genre.lower(), self.scales['поп'])
+        return [self.note_freqs[note] for note in scale_notes]
+    
+    def total_samples(self, length_min, sample_rate=None):
+        return int((sample_rate or self.sample_rate) * length_min * 60)
+    
+    def at_rate(self, render_rate=None):
+        """Генератор с внутренней частотой render_rate (кэши нот у каждой частоты свои)"""
+        if not render_rate or render_rate == self.sample_rate:
+            return self
+        if render_rate not in self.rate_generators:
+            self.rate_generators[render_rate] = ProMusicGenerator(
+                stem_workers=self.stem_workers, segment_workers=self.segment_workers, sample_rate=render_rate
+            )
+        return self.rate_generators[render_rate]
+    
+    def render_key(self, genre, mood, instrument, length_min, tempo_bpm, seed, loudness=None, channels=2,
+                   sample_rate=None, render_rate=None):
+        """Хеш параметров, сида и версии движка — адрес трека в кэше (с частотой рендера и выдачи)"""
+        render_rate = render_rate or self.sample_rate
+        params = [genre, mood, instrument, length_min, tempo_bpm, seed, loudness, channels, render_rate,
+                  sample_rate or render_rate, ENGINE_VERSION]
+        return hashlib.sha256(json.dumps(params, ensure_ascii=False).encode('utf-8')).hexdigest()
+    
+    def track_filename(self, genre, mood, instrument, length_min, tempo_bpm, seed=None, audio_format='wav',
+                       loudness=None, channels=2, sample_rate=None, render_rate=None):
+        # Формат не влияет на звук: WAV и FLAC одного рендера различаются только расширением
+        key = self.render_key(genre, mood, instrument, length_min, tempo_bpm, seed, loudness, channels, sample_rate,
+                              render_rate)
+        return f"master_{genre}_{mood}_{length_min}min_{tempo_bpm}bpm_{key[:16]}.{audio_format}"
+    
+    def encoder(self, length_min, audio_format='wav', channels=2, sample_rate=None):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f'Неизвестный формат: {audio_format}')
+        sample_rate = sample_rate or self.sample_rate
+        total = self.total_samples(length_min, sample_rate)
+        if audio_format == 'flac':
+            return FlacEncoder(sample_rate, channels, total_samples=total)
+        return WavEncoder(sample_rate, channels, total)
+    
+    def render_cost(self, length_min, tempo_bpm, instrument='', audio_format='wav', channels=2, sample_rate=None,
+                    render_rate=None):
+        """Оценка рендера до его начала: сэмплы, пик памяти (МБ) и CPU-секунды.
+        
+        Память растёт с длиной сегмента (16 тактов — чем медленнее темп, тем он
+        длиннее), а не с длиной трека; CPU — с длиной, темпом и числом гармоник.
+        Константы сняты на 44100 Гц; синтез масштабируется частотой рендера,
+        кодирование — частотой выдачи.
+        """
+        render_rate = render_rate or self.sample_rate
+        sample_rate = sample_rate or render_rate
+        samples = self.total_samples(length_min, sample_rate)
+        minutes = length_min
+        segment_samples = min(self.total_samples(length_min, render_rate),
+                              self.segment_bars * BEATS_PER_BAR * 60.0 / tempo_bpm * render_rate)
+        segment_mb = segment_samples * channels * np.dtype(np.float32).itemsize / 2 ** 20
+        copies = COST_SEGMENT_COPIES
+        if self.segment_workers > 1:
+            # Очередь сегментов в родителе и рендер в каждом процессе пула
+            copies = self.segment_workers + 2 + COST_SEGMENT_COPIES * self.segment_workers
+        
+        harmonics = len(self.get_instrument(instrument)['harmonics'])
+        cpu = minutes * COST_CPU_PER_MIN * (0.75 + 0.25 * tempo_bpm / 120) * (0.9 + 0.05 * harmonics)
+        cpu *= render_rate / 44100
+        if sample_rate != render_rate:
+            cpu += minutes * COST_RESAMPLE_CPU_PER_MIN * channels / 2 * max(sample_rate, render_rate) / 44100
+        if audio_format == 'flac':
+            cpu += minutes * COST_FLAC_CPU_PER_MIN * channels / 2 * sample_rate / 44100
+        return {
+            'samples': samples,
+            'memory_mb': round(COST_BASE_MB + segment_mb * copies, 1),
+            'cpu_seconds': round(cpu, 2)
+        }
+    
+    def wav_size(self, length_min, channels=2, sample_rate=None):
+        """Размер WAV-файла в байтах — известен до рендера"""
+        data_size = self.total_samples(length_min, sample_rate) * channels * 2
+        return len(wav_header(self.sample_rate, channels, 0)) + data_size
+    
+    def read_stems(self, stems, buffers, n_samples):
+        """Блок каждой дорожки в свой буфер; с пулом — параллельно.
+        
+        Сведение идёт в фиксированном порядке, поэтому результат побитно
+        совпадает с последовательным рендером.
+        """
+        views = [buf[:n_samples] for buf in buffers]
+        for view in views:
+            view.fill(0)
+        
+        if self.stem_workers > 0 and len(stems) > 1:
+            if self.stem_pool is None:
+                self.stem_pool = ThreadPoolExecutor(self.stem_workers, thread_name_prefix='stem')
+            # Каждой задаче своя копия контекста (таймер стадий)
+            futures = [self.stem_pool.submit(contextvars.copy_context().run, stem.read_into, view)
+                       for stem, view in zip(stems, views)]
+            for future in futures:
+                future.result()
+        else:
+            for stem, view in zip(stems, views):
+                stem.read_into(view)
+        return views
+    
+    def segment_bounds(self, length_min, tempo_bpm):
+        """Границы сегментов в сэмплах, выровненные по тактам"""
+        total_samples = self.total_samples(length_min)
+        segment_samples = self.segment_bars * BEATS_PER_BAR * 60.0 / tempo_bpm * self.sample_rate
+        count = max(1, math.ceil(total_samples / segment_samples))
+        return [int(i * segment_samples) for i in range(count)] + [total_samples]
+    
+    def iter_mix(self, genre, instrument, length_min, tempo_bpm, seed=0, start=0, end=None, block_size=None,
+                 channels=2):
+        """Сведение до мастеринга: блоки float32 (n, channels).
+        
+        Рендерятся только ноты, начинающиеся в окне [start, end), вместе с их
+        хвостами и реверберацией — поэтому соседние окна складываются в полный трек.
+        Буфер блока переиспользуется.
+        """
+        block_size = block_size or self.block_size
+        total_samples = self.total_samples(length_min)
+        end = total_samples if end is None else min(end, total_samples)
+        window = (start, end)
+        
+        with stage('events'):
+            stems = [
+                StemStream(self, events, total_samples, block_size, start=start, name=name)
+                for name, events in self.stem_events(genre, instrument, length_min, tempo_bpm, seed, window).items()
+            ]
+        
+        # Реверберация блоками: хвост окна продлевается на длину ИХ
+        plan = self.master_plan(genre, channels)
+        reverb_tail = self.reverbs.reverb(genre).length
+        stop = min(total_samples, end + max(stem.tail for stem in stems) + reverb_tail)
+        
+        # Буферы дорожек выделяются один раз, буферы графа — в плане
+        stem_buffers = [np.zeros(block_size, dtype=np.float32) for _ in stems]
+        ramp_step = 1.0 / max(total_samples - 1, 1)
+        
+        for pos in range(start, stop, block_size):
+            n_samples = min(block_size, stop - pos)
+            drums, bass, melody = self.read_stems(stems, stem_buffers, n_samples)
+            with stage('master'):
+                block = plan.run(Block(pos, n_samples, ramp_step), drums=drums, bass=bass, melody=melody)
+            # Моно-план отдаёт (n,) — для единой раскладки (n, 1) без копии
+            yield block if block.ndim == 2 else block[:, None]
+    
+    def render_segment(self, genre, instrument, length_min, tempo_bpm, seed, start, end, channels=2):
+        """Сегмент [start, end) с хвостами одним массивом (до мастеринга)"""
+        blocks = [block.copy() for block in
+                  self.iter_mix(genre, instrument, length_min, tempo_bpm, seed, start, end, channels=channels)]
+        return np.concatenate(blocks) if blocks else np.zeros((0, channels), dtype=np.float32)
+    
+    def iter_segments(self, tasks):
+        """Сегменты по порядку; с пулом — параллельно, не больше workers+1 в памяти"""
+        if self.segment_workers <= 1:
+            for task in tasks:
+                yield self.render_segment(**task)
+            return
+        
+        if self.segment_pool is None:
+            self.segment_pool = ProcessPoolExecutor(
+                max_workers=self.segment_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        tasks = iter(tasks)
+        pending = deque()
+        for task in tasks:
+            pending.append(self.segment_pool.submit(_render_segment, task, self.sample_rate))
+            if len(pending) > self.segment_workers:
+                break
+        while pending:
+            segment = pending.popleft().result()
+            task = next(tasks, None)
+            if task is not None:
+                pending.append(self.segment_pool.submit(_render_segment, task, self.sample_rate))
+            yield segment
+    
+    def iter_blocks(self, genre, mood, instrument, length_min, tempo_bpm, block_size=None, seed=None, loudness=None,
+                    channels=2, sample_rate=None):
+        """Потоковый рендер: блоки float32 (n, channels), память не зависит от длины трека.
+        
+        Трек собирается из сегментов по тактам сшивкой хвостов (overlap-add),
+        мастер — усиление (loudness — целевой RMS в дБ FS) и лимитер; если
+        частота выдачи sample_rate другая — полифазная передискретизация.
+        Один и тот же seed даёт один и тот же трек при любом числе процессов.
+        Блок нужно обработать до следующей итерации.
+        """
+        block_size = block_size or self.block_size
+        if seed is None:
+            seed = random.getrandbits(31)
+        bounds = self.segment_bounds(length_min, tempo_bpm)
+        spans = list(zip(bounds, bounds[1:]))
+        tasks = [
+            {'genre': genre, 'instrument': instrument, 'length_min': length_min, 'tempo_bpm': tempo_bpm,
+             'seed': seed, 'start': s0, 'end': s1, 'channels': channels}
+            for s0, s1 in spans
+        ]
+        
+        limiter = Limiter(self.sample_rate, channels)
+        resampler = None
+        if sample_rate and sample_rate != self.sample_rate:
+            resampler = Resampler(self.sample_rate, sample_rate, channels)
+        gain = None
+        carry = np.zeros((0, channels), dtype=np.float32)
+        for (s0, s1), segment in zip(spans, self.iter_segments(tasks)):
+            if len(carry) > len(segment):
+                segment = np.concatenate((segment, np.zeros((len(carry) - len(segment), channels), dtype=np.float32)))
+            segment[:len(carry)] += carry
+            body, carry = segment[:s1 - s0], segment[s1 - s0:]
+            if gain is None:
+                gain = self.loudness_gain(body, loudness)
             
-            if start + len(note) < total_samples:
-                melody[start:start+len(note)] += note
+            for i in range(0, len(body), block_size):
+                out = body[i:i + block_size]
+                with stage('limiter'):
+                    out *= gain
+                    out = limiter.process(out)
+                if resampler is not None:
+                    with stage('resample'):
+                        out = resampler.process(out)
+                if len(out):
+                    yield out
+        with stage('limiter'):
+            out = limiter.flush()
+        if resampler is not None:
+            with stage('resample'):
+                out = np.concatenate((resampler.process(out), resampler.flush()))
+        yield out
+    
+    def loudness_gain(self, audio, loudness=None):
+        """Усиление мастера: фиксированное или по RMS (дБ FS) первого сегмента.
         
-        return melody
+        Весь трек для нормализации не нужен — пики всё равно срезает лимитер.
+        """
+        rms = float(np.sqrt(np.mean(np.square(audio, dtype=np.float64)))) if len(audio) else 0.0
+        if loudness is None or rms == 0:
+            return np.float32(self.master_gain)
+        loudness = min(max(float(loudness), LOUDNESS_RANGE[0]), LOUDNESS_RANGE[1])
+        return np.float32(min(max(10 ** (loudness / 20) / rms, 0.1), 20.0))
+    
+    def iter_pcm16(self, genre, mood, instrument, length_min, tempo_bpm, block_size=None, seed=None, loudness=None,
+                   channels=2, sample_rate=None):
+        """Те же блоки, переведённые в int16 (буфер тоже переиспользуется)"""
+        pcm = np.empty((block_size or self.block_size, channels), dtype='<i2')
+        for block in self.iter_blocks(genre, mood, instrument, length_min, tempo_bpm, block_size, seed, loudness,
+                                      channels, sample_rate):
+            with stage('pcm'):
+                if len(block) > len(pcm):
+                    # После передискретизации вверх блок длиннее исходного
+                    pcm = np.empty((len(block), channels), dtype='<i2')
+                block *= 32767
+                out = pcm[:len(block)]
+                np.copyto(out, block, casting='unsafe')
+            yield out
     
-    def generate_music(self, genre, mood, instrument, length_min, tempo_bpm, description=""):
-        print(f"🎵 🎼 СУПЕР ПРО: {genre} | {mood} | {tempo_bpm} BPM")
+    def iter_wav_bytes(self, genre, mood, instrument, length_min, tempo_bpm, block_size=None, seed=None, loudness=None,
+                       channels=2, sample_rate=None):
+        """WAV-файл кусками: сначала заголовок, затем PCM по мере рендера"""
+        sample_rate = sample_rate or self.sample_rate
+        yield wav_header(sample_rate, channels, self.total_samples(length_min, sample_rate))
+        for pcm in self.iter_pcm16(genre, mood, instrument, length_min, tempo_bpm, block_size, seed, loudness,
+                                   channels, sample_rate):
+            yield pcm.tobytes()
+    
+    def iter_audio_bytes(self, genre, mood, instrument, length_min, tempo_bpm, block_size=None, seed=None,
+                         audio_format='wav', loudness=None, channels=2, sample_rate=None, render_rate=None):
+        """Файл в выбранном формате кусками (у потокового FLAC в STREAMINFO нет MD5)"""
+        if render_rate and render_rate != self.sample_rate:
+            yield from self.at_rate(render_rate).iter_audio_bytes(genre, mood, instrument, length_min, tempo_bpm,
+                                                                  block_size, seed, audio_format, loudness, channels,
+                                                                  sample_rate)
+            return
+        encoder = self.encoder(length_min, audio_format, channels, sample_rate)
+        yield encoder.head()
+        for pcm in self.iter_pcm16(genre, mood, instrument, length_min, tempo_bpm, block_size, seed, loudness,
+                                   channels, sample_rate):
+            data = encoder.encode(pcm)
+            if data:
+                yield data
+        yield encoder.flush()
+    
+    def render_file(self, filepath, genre, mood, instrument, length_min, tempo_bpm, seed=None,
+                    audio_format='wav', loudness=None, channels=2, sample_rate=None, render_rate=None, progress=None):
+        """Рендер в файл; время синтеза и кодирования считается отдельно.
         
-        duration = length_min * 60
-        total_samples = int(self.sample_rate * duration)
+        render_rate — внутренняя частота (по умолчанию своя), sample_rate — частота
+        файла (по умолчанию как у рендера). progress(fraction) вызывается после
+        каждого блока.
+        """
+        if render_rate and render_rate != self.sample_rate:
+            return self.at_rate(render_rate).render_file(filepath, genre, mood, instrument, length_min, tempo_bpm,
+                                                         seed, audio_format, loudness, channels, sample_rate,
+                                                         progress=progress)
+        if audio_format == 'wav':
+            return self.render_wav(filepath, genre, mood, instrument, length_min, tempo_bpm, seed, loudness, channels,
+                                   sample_rate, progress)
         
-
-        scale_notes = self.scales.get(genre.lower(), self.scales['поп'])
-        scale = [self.note_freqs[note] for note in scale_notes]
+        encoder = self.encoder(length_min, audio_format, channels, sample_rate)
+        total = self.total_samples(length_min, sample_rate)
+        blocks = self.iter_pcm16(genre, mood, instrument, length_min, tempo_bpm, seed=seed, loudness=loudness,
+                                 channels=channels, sample_rate=sample_rate)
+        render_time = encode_time = 0.0
+        done = 0
         
-
-        drums = self.generate_drums(duration, tempo_bpm)
-        bass = self.generate_bassline(scale, duration, tempo_bpm)
-        melody = self.generate_melody(scale, duration, instrument)
+        with open(filepath, 'wb') as f:
+            f.write(encoder.head())
+            while True:
+                started = time.perf_counter()
+                pcm = next(blocks, None)
+                rendered = time.perf_counter()
+                render_time += rendered - started
+                if pcm is None:
+                    break
+                with stage('encode'):
+                    data = encoder.encode(pcm)
+                with stage('write'):
+                    f.write(data)
+                encode_time += time.perf_counter() - rendered
+                done += len(pcm)
+                if progress:
+                    progress(done / total)
+            started = time.perf_counter()
+            with stage('encode'):
+                data = encoder.flush()
+            with stage('write'):
+                f.write(data)
+                # Заголовок той же длины, теперь с MD5 и размерами кадров
+                f.seek(0)
+                f.write(encoder.head())
+            encode_time += time.perf_counter() - started
+            size = f.seek(0, os.SEEK_END)
         
-
-        mix = melody * 0.5 + bass * 0.4 + drums * 0.35
+        return {
+            'render_time': round(render_time, 3),
+            'encode_time': round(encode_time, 3),
+            'bytes': size
+        }
+    
+    def render_wav(self, filepath, genre, mood, instrument, length_min, tempo_bpm, seed=None, loudness=None,
+                   channels=2, sample_rate=None, progress=None):
+        """WAV через отображение файла в память: encode_time — перевод в int16 и сброс на диск"""
+        sample_rate = sample_rate or self.sample_rate
+        total = self.total_samples(length_min, sample_rate)
+        sink = WavMemmapSink(filepath, sample_rate, channels, total)
+        blocks = self.iter_blocks(genre, mood, instrument, length_min, tempo_bpm, seed=seed, loudness=loudness,
+                                  channels=channels, sample_rate=sample_rate)
+        render_time = encode_time = 0.0
         
-
-        reverb = np.roll(mix * 0.2, int(0.1 * self.sample_rate))
-        mix += reverb * np.linspace(1, 0.2, len(mix))
+        try:
+            while True:
+                started = time.perf_counter()
+                block = next(blocks, None)
+                rendered = time.perf_counter()
+                render_time += rendered - started
+                if block is None:
+                    break
+                with stage('pcm'):
+                    sink.write(block)
+                encode_time += time.perf_counter() - rendered
+                if progress:
+                    progress(sink.pos / total)
+            if sink.pos != total:
+                raise ValueError(f'Записано {sink.pos} сэмплов из {total}')
+            started = time.perf_counter()
+            with stage('write'):
+                sink.close()
+            encode_time += time.perf_counter() - started
+        finally:
+            blocks.close()
+            sink.close()
         
-
-        left = mix * np.linspace(0.8, 1.0, len(mix))
-        right = mix * np.linspace(1.0, 0.8, len(mix))
-        stereo = np.stack((left, right), axis=1).flatten()
+        return {
+            'render_time': round(render_time, 3),
+            'encode_time': round(encode_time, 3),
+            'bytes': os.path.getsize(filepath)
+        }
+    
+    def preview(self, genre, mood, instrument, length_min, tempo_bpm, seed=None, seconds=15, loudness=None):
+        """Отрывок из середины трека: моно int16 на PREVIEW_SAMPLE_RATE.
         
-
-        stereo = stereo / np.max(np.abs(stereo)) * 0.92
-        audio = (stereo * 32767).astype(np.int16)
+        Ноты берутся из тех же тактов и с тем же seed, что и в полном треке,
+        поэтому превью звучит как соответствующий фрагмент (проще по тембру).
+        """
+        if self.preview_generator is None:
+            self.preview_generator = ProMusicGenerator(
+                stem_workers=0, segment_workers=1,
+                sample_rate=PREVIEW_SAMPLE_RATE, max_harmonic=PREVIEW_MAX_HARMONIC
+            )
+        g = self.preview_generator
+        if seed is None:
+            seed = random.getrandbits(31)
+        
+        total_samples = g.total_samples(length_min)
+        n_samples = min(int(min(max(seconds, PREVIEW_SECONDS[0]), PREVIEW_SECONDS[1]) * g.sample_rate), total_samples)
+        bar_samples = BEATS_PER_BAR * 60.0 / tempo_bpm * g.sample_rate
+        start = int(int((total_samples - n_samples) / 2 / bar_samples) * bar_samples)
+        # Такт до начала рендерится ради нот, которые звучат на стыке
+        lead = start - int(max(start - bar_samples, 0))
+        
+        out = np.empty(lead + n_samples, dtype=np.float32)
+        pos = 0
+        for block in g.iter_mix(genre, instrument, length_min, tempo_bpm, seed, start - lead, start + n_samples,
+                                channels=1):
+            n = min(len(block), len(out) - pos)
+            out[pos:pos + n] = block[:n, 0]
+            pos += n
+            if pos == len(out):
+                break
+        
+        out = out[lead:pos]
+        out *= g.loudness_gain(out, loudness)
+        limiter = Limiter(g.sample_rate, channels=1)
+        out = np.concatenate((limiter.process(out[:, None]), limiter.flush()))
+        out *= 32767
+        return out[:, 0].astype('<i2')
+    
+    def preview_wav(self, genre, mood, instrument, length_min, tempo_bpm, seed=None, seconds=15, loudness=None):
+        pcm = self.preview(genre, mood, instrument, length_min, tempo_bpm, seed, seconds, loudness)
+        return wav_header(PREVIEW_SAMPLE_RATE, 1, len(pcm)) + pcm.tobytes()
+    
+    def generate_music(self, genre, mood, instrument, length_min, tempo_bpm, description="", seed=None,
+                       audio_format='wav', preview=False, loudness=None, channels=2, sample_rate=None,
+                       render_rate=None):
+        # Сид выбирается до имени файла: иначе разные треки без сида получат одно имя
+        if seed is None:
+            seed = random.getrandbits(31)
+        
+        if preview:
+            # Превью не кэшируется и не кодируется: отдаётся сразу WAV
+            os.makedirs('generated', exist_ok=True)
+            key = self.render_key(genre, mood, instrument, length_min, tempo_bpm, seed, loudness)
+            filename = f"preview_{genre}_{mood}_{tempo_bpm}bpm_{key[:16]}.wav"
+            with open(os.path.join('generated', filename), 'wb') as f:
+                f.write(self.preview_wav(genre, mood, instrument, length_min, tempo_bpm, seed, loudness=loudness))
+            print(f"👂 ПРЕВЬЮ: {filename}")
+            return filename
+        
+        print(f"🎵 🎼 СУПЕР ПРО: {genre} | {mood} | {tempo_bpm} BPM | seed {seed} | {audio_format} | {channels} кан.")
         
-
         os.makedirs('generated', exist_ok=True)
-        filename = f"master_{genre}_{mood}_{length_min}min_{tempo_bpm}bpm.wav"
+        filename = self.track_filename(genre, mood, instrument, length_min, tempo_bpm, seed, audio_format, loudness,
+                                       channels, sample_rate, render_rate)
         filepath = os.path.join('generated', filename)
-        write(filepath, self.sample_rate, audio)
         
-        print(f"✅ 🎵 МАСТЕР ТРЕК: {filename}")
-        return filename
\ No newline at end of file
+        stats = self.render_file(filepath, genre, mood, instrument, length_min, tempo_bpm, seed, audio_format, loudness,
+                                 channels, sample_rate, render_rate)
+        
+        print(f"✅ 🎵 МАСТЕР ТРЕК: {filename} | рендер {stats['render_time']} с | "
+              f"кодирование {stats['encode_time']} с | {stats['bytes']} байт")
+        return filename
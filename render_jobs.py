@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from music_generator import ProMusicGenerator, RenderCache, StageTimer, stage
+from request_log import RequestLog
+from metrics import Metrics
+
+# Состояние задач живёт в файлах: его видят все воркеры gunicorn
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+
+# Сколько хранятся файлы завершённых задач (статус успевают забрать) и как часто их чистить, секунды
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION_HOURS', 24)) * 3600
+PRUNE_INTERVAL = 600
+
+_generator = None
+_metrics = None
+
+
+def _worker_generator():
+    """Генератор процесса-воркера: кэш нот общий для всех его задач"""
+    global _generator
+    if _generator is None:
+        _generator = ProMusicGenerator()
+    return _generator
+
+
+def _worker_metrics():
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+class JobStore:
+    """Файловое хранилище задач рендера: jobs/<id>.json"""
+
+    def __init__(self, directory='jobs'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def load(self, job_id):
+        try:
+            with open(self.path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, job):
+        """Атомарная запись: читатели не увидят половину файла"""
+        job['updated'] = time.time()
+        tmp_path = f'{self.path(job["id"])}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path(job['id']))
+
+    def update(self, job_id, **fields):
+        job = self.load(job_id)
+        if job is not None:
+            job.update(fields)
+            self.save(job)
+        return job
+
+    def pending(self):
+        """Задачи, которые не успели завершиться (для возобновления)"""
+        jobs = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                job = self.load(name[:-5])
+                if job and job['status'] in ('queued', 'running'):
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job['created'])
+
+    def prune(self, max_age=JOB_RETENTION):
+        """Удаление завершённых задач старше max_age секунд; возвращает их число"""
+        removed = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            job = self.load(name[:-5])
+            if job and job['status'] in ('done', 'failed') and now - job.get('updated', job['created']) > max_age:
+                try:
+                    os.remove(self.path(job['id']))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def claim(self, job_id):
+        """Захват задачи процессом: lock-файл с pid, устаревший lock перехватывается"""
+        lock_path = self.path(job_id) + '.lock'
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(lock_path) as f:
+                    os.kill(int(f.read()), 0)
+                return False
+            except (ProcessLookupError, ValueError):
+                os.remove(lock_path)
+                return self.claim(job_id)
+            except OSError:
+                return False
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return True
+
+    def release(self, job_id):
+        try:
+            os.remove(self.path(job_id) + '.lock')
+        except FileNotFoundError:
+            pass
+
+
+def run_job(job_id, params, jobs_dir, upload_dir, filename):
+    """Рендер в процессе-воркере с записью прогресса в файл задачи"""
+    store = JobStore(jobs_dir)
+    store.update(job_id, status='running', progress=0, started=time.time())
+
+    generator = _worker_generator()
+    metrics = _worker_metrics()
+    timer = StageTimer()
+    started = time.perf_counter()
+    final_path = os.path.join(upload_dir, filename)
+    part_path = f'{final_path}.{job_id}.part'
+    last_report = 0
+
+    def progress(fraction):
+        nonlocal last_report
+        if time.time() - last_report > 0.5:
+            last_report = time.time()
+            store.update(job_id, progress=round(100 * fraction, 1))
+
+    try:
+        with metrics.in_flight('job'), timer.activate():
+            stats = generator.render_file(part_path, **params, progress=progress)
+            with stage('rename'):
+                os.replace(part_path, final_path)
+            with stage('midi'):
+                generator.write_midi(upload_dir, params)
+    except Exception as e:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        store.update(job_id, status='failed', error=str(e))
+        RequestLog().append(route='job', job_id=job_id, status='failed', error=str(e),
+                            total=round(time.perf_counter() - started, 4), stages=timer.snapshot())
+        raise
+
+    metrics.observe_render('job', params, time.perf_counter() - started, stats['bytes'])
+    metrics.cache_stats('note_cache', generator.note_cache.stats())
+    metrics.cache_stats('envelope_cache', generator.envelopes.stats())
+    metrics.flush()
+    timings = timer.snapshot()
+    RequestLog().append(route='job', job_id=job_id, status='done', params=params, filename=filename,
+                        total=round(time.perf_counter() - started, 4), stages=timings)
+
+    store.update(job_id, status='done', progress=100, finished=time.time(),
+                 download_url=f'/files/{filename}', midi_url=f'/midi/{filename}',
+                 render_time=stats['render_time'], timings=timings,
+                 encode_time=stats['encode_time'])
+    return filename
+
+
+class JobManager:
+    """Ограниченный пул процессов для фонового рендера.
+
+    С admission задача занимает бюджет рендеров (оценка cost(params)) от
+    постановки до завершения; не поместилась — submit бросает Overloaded.
+    """
+
+    def __init__(self, store, generator, upload_dir, max_workers=2, max_queued=32, on_done=None,
+                 admission=None, cost=None, render_cache=None):
+        self.store = store
+        self.generator = generator
+        self.upload_dir = upload_dir
+        # Общий с синхронными маршрутами кэш: задачи попадают в его статистику попаданий
+        self.render_cache = render_cache or RenderCache(upload_dir)
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.on_done = on_done
+        self.admission = admission
+        self.cost = cost
+        self.tickets = {}
+        self.executor = None
+        self.futures = {}
+        self.filenames = {}
+        # Сессии, запросившие уже рендерящийся трек: файл появится и у них
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.pruned = 0
+
+    def _pool(self):
+        # Пул создаётся лениво: воркеры gunicorn не держат процессы зря
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self.executor
+
+    def active(self):
+        with self.lock:
+            return len(self.futures)
+
+    def submit(self, params, session_id=None, description=''):
+        """Новая задача; None — очередь переполнена или сервер останавливается"""
+        self.prune()
+        filename = self.generator.track_filename(**params)
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'progress': 0,
+            'params': params,
+            'filename': filename,
+            'session_id': session_id,
+            'description': description,
+            'created': time.time()
+        }
+
+        # Готовый трек из кэша — задача сразу завершена
+        if self.render_cache.lookup(filename):
+            self.generator.write_midi(self.upload_dir, params)
+            job.update(status='done', progress=100, cached=True, download_url=f'/files/{filename}',
+                       midi_url=f'/midi/{filename}')
+            self.store.save(job)
+            if self.on_done:
+                self.on_done(job)
+            return job
+
+        with self.lock:
+            # Такой же трек уже рендерится — отдаём ту же задачу
+            if filename in self.filenames:
+                job_id = self.filenames[filename]
+                self.subscribers.setdefault(job_id, []).append((session_id, description))
+                return self.store.load(job_id) or job
+            if self.closed or len(self.futures) >= self.max_queued:
+                return None
+        if self.admission is not None:
+            # Ответ на постановку не ждёт: клиент повторит через Retry-After
+            self.tickets[job['id']] = self.admission.admit(self.cost(params), timeout=0)
+        self.store.save(job)
+        self.store.claim(job['id'])
+        self._start(job)
+        return job
+
+    def _start(self, job):
+        args = (job['id'], job['params'], self.store.directory, self.upload_dir, job['filename'])
+        try:
+            try:
+                future = self._pool().submit(run_job, *args)
+            except BrokenProcessPool:
+                # Упавший воркер ломает весь пул — пересоздаём
+                self.executor = None
+                future = self._pool().submit(run_job, *args)
+        except Exception:
+            self._release_budget(job['id'])
+            raise
+        with self.lock:
+            self.futures[job['id']] = future
+            self.filenames[job['filename']] = job['id']
+        future.add_done_callback(lambda f, job_id=job['id']: self._finished(job_id, f))
+
+    def _release_budget(self, job_id):
+        ticket = self.tickets.pop(job_id, None)
+        if ticket is not None:
+            self.admission.release(ticket)
+
+    def _finished(self, job_id, future):
+        with self.lock:
+            self.futures.pop(job_id, None)
+            self.filenames = {name: jid for name, jid in self.filenames.items() if jid != job_id}
+            subscribers = self.subscribers.pop(job_id, [])
+        self._release_budget(job_id)
+        if future.cancelled():
+            # Отменённая при остановке задача остаётся в очереди на диске
+            self.store.release(job_id)
+            return
+        if future.exception() is not None:
+            self.store.update(job_id, status='failed', error=str(future.exception()))
+        else:
+            job = self.store.load(job_id)
+            if job and self.on_done:
+                self.on_done(job)
+                for session_id, description in subscribers:
+                    self.on_done({**job, 'session_id': session_id, 'description': description})
+        self.store.release(job_id)
+
+    def prune(self):
+        """Чистка старых задач не чаще раза в PRUNE_INTERVAL"""
+        if time.time() - self.pruned > PRUNE_INTERVAL:
+            self.pruned = time.time()
+            self.store.prune()
+
+    def resume(self):
+        """Возобновление задач, оставшихся после прошлой остановки"""
+        self.prune()
+        resumed = 0
+        for job in self.store.pending():
+            if self.store.claim(job['id']):
+                job.update(status='queued', progress=0)
+                self.store.save(job)
+                if self.admission is not None:
+                    # Задача уже принята — бюджет занимается без проверки
+                    self.tickets[job['id']] = self.admission.occupy(self.cost(job['params']))
+                self._start(job)
+                resumed += 1
+        return resumed
+
+    def shutdown(self, wait=True):
+        """Мягкая остановка: идущие рендеры дорабатывают, очередь остаётся на диске"""
+        with self.lock:
+            self.closed = True
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,38 @@
+import os
+import json
+import time
+import threading
+
+
+def server_timing(stages, total=None):
+    """Заголовок Server-Timing: стадии в миллисекундах"""
+    items = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in stages.items()]
+    if total is not None:
+        items.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(items)
+
+
+# Журнал по умолчанию; путь общий для веб-процессов и воркеров рендера
+DEFAULT_LOG_PATH = os.environ.get('REQUEST_LOG', os.path.join('logs', 'requests.jsonl'))
+
+
+class RequestLog:
+    """Структурированный журнал запросов: одна JSON-строка на запрос или задачу.
+
+    Запись идёт одним write() в режиме добавления, поэтому строки от
+    разных процессов gunicorn и воркеров рендера не перемешиваются.
+    """
+
+    def __init__(self, path=DEFAULT_LOG_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def append(self, **record):
+        record.setdefault('time', time.time())
+        record.setdefault('pid', os.getpid())
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
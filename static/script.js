@@ -89,7 +89,7 @@ document.getElementById("generateMusicButton").addEventListener("click", async (
             return;
         }
 
-        const response = await fetch('/generate_music', {
+        const response = await fetch('/api/jobs', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -106,7 +106,20 @@ document.getElementById("generateMusicButton").addEventListener("click", async (
             })
         });
 
-        const result = await response.json();
+        let result = await response.json();
+
+        // Рендер идёт в фоне — опрашиваем статус задачи
+        while (result.success && result.status !== 'done' && result.status !== 'failed') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const statusResponse = await fetch(`/api/jobs/${result.job_id}`);
+            result = await statusResponse.json();
+            if (result.success && result.status === 'running') {
+                resultElement.textContent = `🎵 Создаю уникальный трек... ${Math.round(result.progress)}%`;
+            }
+        }
+        if (result.status === 'failed') {
+            result.success = false;
+        }
 
         if (result.success) {
 